@@ -1,14 +1,6 @@
-import requests
 import streamlit as st
 from login import show_login_page  # 引入登录逻辑
-import pandas as pd
-import io
-from datetime import datetime
-import pytz
-from streamlit_gsheets import GSheetsConnection
-from logic import get_live_rates, get_dynamic_options, ISO_MAP, prepare_new_data
-from logic import ALL_PROPS, CORE_BIZ, INC_OTHER, EXP_OTHER
-from forms import entry_dialog, edit_dialog, row_action_dialog
+from warmup import start_prewarm
 
 # --- 1. 基础页面配置 ---
 st.set_page_config(page_title="富邦日记账", layout="wide", page_icon="📊")
@@ -19,9 +11,26 @@ if "logged_in" not in st.session_state:
 
 # 如果没登录，直接运行登录页并停止向下执行
 if not st.session_state.logged_in:
+    # 用户输入账号密码的同时，在后台导入重模块并同步、缓存首屏数据
+    start_prewarm()
     show_login_page()
     st.stop()  # 🌟 关键：未登录时拦截后续所有代码运行
 
+# 登录之后才导入 pandas、账本存储等重模块，登录页只依赖 streamlit
+import os
+import threading
+from datetime import datetime
+import pandas as pd
+import pytz
+from logic import ISO_MAP, normalize_ledger, to_sheet_frame, page_slice, fx_revaluation, get_rates_on, account_balances
+from logic import period_cube_source, build_period_cube, update_period_cube, cube_month
+from forms import entry_dialog, edit_dialog, row_action_dialog, bulk_import_dialog
+from mirror import get_mirror, publish_write, read_ledger, read_summaries, UNDATED
+from store import get_ledger_store
+from wecom import sync_wecom_to_sheets
+from export import month_export, year_export, EXPORT_MODES, XLSX_MIME
+import perf
+
 # 主界面多语言字典
 MAIN_LANG = {
     "zh": {
@@ -35,6 +44,7 @@ MAIN_LANG = {
         "stat_balance": "当前结余",
         "table_title": "📊 日常收支",
         "btn_add": "➕ 新增流水录入",
+        "btn_import": "📥 批量导入",
     },
     "en": {
         "title_main": "Fubang Journal",
@@ -47,6 +57,7 @@ MAIN_LANG = {
         "stat_balance": "Current Balance",
         "table_title": "📊 Statistics Summary",
         "btn_add": "➕ Add New Transaction",
+        "btn_import": "📥 Bulk Import",
     },
     "km": {
         "title_main": "ហ្វូបង់ សៀវភៅគណនេយ្យោះ",
@@ -59,6 +70,7 @@ MAIN_LANG = {
         "stat_balance": "សមតុល្យបច្ចុប្បន្ន",
         "table_title": "📊 សេចក្តីសង្ខេបស្ថិតិ",
         "btn_add": "➕ បញ្ចូលទិន្នន័យថ្មី",
+        "btn_import": "📥 នាំចូលជាបណ្តុំ",
     },
     "vi": {
         "title_main": "Sổ Kế Toán Fubang",
@@ -71,6 +83,7 @@ MAIN_LANG = {
         "stat_balance": "Số dư hiện tại",
         "table_title": "📊 Thống kê tổng hợp",
         "btn_add": "➕ Thêm giao dịch mới",
+        "btn_import": "📥 Nhập hàng loạt",
     }
 }
 
@@ -79,6 +92,26 @@ L_MAIN = MAIN_LANG.get(st.session_state.lang, MAIN_LANG["zh"])
 
 LOCAL_TZ = pytz.timezone('Asia/Phnom_Penh')
 
+# 性能面板只对管理员开放：环境变量 LEDGER_PERF=1 或 secrets 里 PERF_PANEL = true 打开开关，
+# 且当前登录账号在管理员名单里（secrets 的 PERF_ADMINS 列表，或环境变量 LEDGER_PERF_ADMINS 逗号分隔）
+def _secret(key, default=None):
+    try:
+        return st.secrets.get(key, default)
+    except Exception:
+        return default
+
+def _perf_panel_allowed():
+    if not (os.environ.get("LEDGER_PERF") == "1" or bool(_secret("PERF_PANEL", False))):
+        return False
+    admins = os.environ.get("LEDGER_PERF_ADMINS")
+    admins = [a.strip() for a in admins.split(",")] if admins else list(_secret("PERF_ADMINS", []))
+    return st.session_state.get("username") in admins
+
+PERF_PANEL = _perf_panel_allowed()
+_perf_leftover = perf.begin_run(PERF_PANEL and st.session_state.get("perf_enabled", False))
+if _perf_leftover:
+    st.session_state._perf_last = _perf_leftover
+
 # 初始化全局状态
 if "table_version" not in st.session_state:
     st.session_state.table_version = 0
@@ -90,129 +123,70 @@ if "current_active_id" not in st.session_state:
     st.session_state.current_active_id = None
 
 # --- 2. 数据加载函数 ---
-conn = st.connection("gsheets", type=GSheetsConnection)
-
-# --- 升级版：企业微信同步函数 ---
-def sync_wecom_to_sheets(conn):
-    try:
-        CORPID = st.secrets["WECOM_CORPID"]
-        SECRET = st.secrets["WECOM_SECRET"]
-        TEMPLATE_ID = st.secrets["WECOM_TEMPLATE_ID"]
-        
-        # 1. 获取 Access Token
-        token_url = f"https://qyapi.weixin.qq.com/cgi-bin/gettoken?corpid={CORPID}&corpsecret={SECRET}"
-        token_res = requests.get(token_url).json()
-        token = token_res.get("access_token")
-        if not token: return f"❌ Token获取失败: {token_res.get('errmsg')}"
-
-        # 2. 获取最近 7 天已通过审批列表 (sp_status=2)
-        import time
-        now = int(time.time())
-        start_time = str(now - (30 * 24 * 3600))
-        list_url = f"https://qyapi.weixin.qq.com/cgi-bin/oa/getapprovalinfo?access_token={token}"
-        payload = {
-            "starttime": str(now - 604800), "endtime": str(now),
-            "cursor": 0, "size": 100,
-            "filters": [{"key": "template_id", "value": TEMPLATE_ID}, {"key": "sp_status", "value": "2"}]
-        }
-        res_list = requests.post(list_url, json=payload).json()
-        st.sidebar.write("调试信息:", res_list)
-        sp_nos = res_list.get("sp_no_list", [])
-        if not sp_nos:
-            # 这里的报错信息会根据腾讯返回的内容自动变化
-            errmsg = res_list.get("errmsg", "无报错")
-            return f"📭 抓取失败。返回码: {res_list.get('errcode')}, 原因: {errmsg}。请确认单据是否在30天内且已完全审批通过。"
-
-        # 3. 读取现有数据去重 (确保 worksheet 名字为 Summary)
-        df_existing = conn.read(worksheet="Summary", ttl=0)
-        existing_ids = df_existing['录入编号'].astype(str).tolist() if '录入编号' in df_existing.columns else []
-
-        # 获取当前汇率
-        rates = get_live_rates()
-
-        new_rows = []
-        detail_url = f"https://qyapi.weixin.qq.com/cgi-bin/oa/getapprovaldetail?access_token={token}"
-        
-        for sp_no in sp_nos:
-            # 使用 WE-加后8位 作为录入编号去重
-            uid = f"WE-{sp_no[-8:]}"
-            if uid in existing_ids: continue
-            
-            det_res = requests.post(detail_url, json={"sp_no": sp_no}).json()
-            if det_res.get("errcode") != 0: continue
-            
-            info = det_res.get("info", {})
-            contents = info.get("apply_data", {}).get("contents", [])
-            
-            try:
-                # --- 核心字段映射 (根据 CSV 逻辑) ---
-                # contents[0]: 费用类型 (如 管理费)
-                # contents[1]: 申请事由
-                # contents[2]: 币种 (人民币/美元)
-                # contents[3]: 金额 (数字)
-                # contents[7]: 备注
-                
-                cat_type = contents[0]['value']['text']
-                reason   = contents[1]['value']['text']
-                currency = contents[2]['value']['text']
-                raw_amt  = float(contents[3]['value']['new_number'])
-                
-                # 币种对齐
-                final_curr = "CNY" if "人民币" in currency else "USD"
-                
-                # 计算折合美元
-                exp_usd = round(raw_amt / rates.get(final_curr, 1.0), 2)
-                
-                # 时间处理：使用完成时间 (sp_finish_time)
-                # 如果单据还没完成时间，用申请时间保底
-                finish_ts = info.get('sp_finish_time', info.get('apply_time'))
-                finish_dt = datetime.fromtimestamp(finish_ts).strftime('%Y-%m-%d %H:%M')
-
-                new_rows.append({
-                    "录入编号": uid,
-                    "提交时间": finish_dt,  # ✅ 完成时间 对应 提交时间
-                    "修改时间": "",
-                    "摘要": reason,
-                    "客户/项目信息": "企微同步",
-                    "结算账户": "待分类",
-                    "审批/发票单号": sp_no,  # ✅ 审批编号 对应 审批/发票单号
-                    "资金性质": cat_type,
-                    "实际金额": raw_amt,
-                    "实际币种": final_curr,
-                    "收入(USD)": 0.0,
-                    "支出(USD)": exp_usd,
-                    "余额(USD)": 0.0, # 稍后计算
-                    "经手人": info.get("applyer", {}).get("name"),
-                    "备注": contents[7]['value']['text'] if len(contents) > 7 else "来自企微同步"
-                })
-            except Exception:
-                continue
-
-        if new_rows:
-            df_new = pd.DataFrame(new_rows)
-            # 合并并重算余额
-            df_final = pd.concat([df_existing, df_new], ignore_index=True)
-            df_final = calculate_full_balance(df_final)
-            
-            # 更新云端
-            conn.update(worksheet="Summary", data=df_final)
-            # 更新版本号触发主界面刷新
-            st.session_state.table_version += 1
-            return f"✅ 成功从企微同步 {len(new_rows)} 条数据！"
-            
-        return "😴 云端已是最新，无新单据需要同步"
-        
-    except Exception as e:
-        return f"❌ 出错了: {str(e)}"
-@st.cache_data(ttl=300)
-def load_data(version=0):
+# 账本存储后端由 LEDGER_BACKEND 选择（默认 Google Sheets）
+store = get_ledger_store()
+
+# 本地镜像：看板一律读本地 SQLite，云端只做增量同步
+mirror = get_mirror()
+SYNC_INTERVAL = 300   # 两次增量同步的最小间隔 (秒)
+
+@st.cache_resource
+def _period_cube_cache():
+    # 进程内共享的时间维度聚合表：{revision, years, cube, src}
+    return {"lock": threading.Lock()}
+
+def load_period_cube(df):
+    # 同一数据版本直接复用；相邻版本只对改动起始行之后的尾部做增量更新
+    rev, years = df.attrs.get("revision"), df.attrs.get("years")
+    cache = _period_cube_cache()
+    with cache["lock"]:
+        same_part = "src" in cache and cache.get("years") == years
+        if rev is not None and same_part and cache.get("revision") == rev:
+            return cache["cube"]
+        start = None
+        if rev is not None and same_part and cache.get("revision") == rev - 1:
+            start = df.attrs.get("changed_from")
+        if start is not None and start <= len(cache["src"]):
+            new_tail = period_cube_source(df.iloc[start:])
+            cube = update_period_cube(cache["cube"], removed=cache["src"].iloc[start:], added=new_tail)
+            src = pd.concat([cache["src"].iloc[:start], new_tail])
+        else:
+            src = period_cube_source(df)
+            cube = build_period_cube(src)
+        cache.update(revision=rev, years=years, cube=cube, src=src)
+        return cube
+
+def sync_mirror():
+    # 每次 rerun 只调用一次（见第 2 节末尾）。
+    # 本进程的写入已由写入方直接应用到共享镜像（见 mirror.publish_write），各会话凭版本号读到新数据；
+    # 只在超过同步间隔、或有写入未能直接应用 (mirror.dirty) 时访问云端，失败后按退避间隔重试
+    empty = not mirror.revision
+    if mirror.due(SYNC_INTERVAL) or (empty and mirror.syncing):
+        # 镜像已有数据时同步只在后台进行，本次直接展示本地数据；镜像为空（首次启动）时才等待
+        # 本次重跑只计等待时长；读取存储的耗时与字节数由后台线程在同步结束时写入日志 ("mirror.sync")
+        with perf.span("mirror.sync_wait"):
+            mirror.sync_async(store, wait=None if empty else 0, log=perf.is_enabled())
+    if mirror.syncing:
+        st.sidebar.caption("⏳ 正在后台同步云端数据，暂时显示本地数据")
+    if mirror.last_error is not None:
+        st.sidebar.warning(f"⚠️ 云端同步异常，当前为本地只读数据: {mirror.last_error}")
+
+def load_data(years=None):
+    # years 为空时加载完整账本（写入、去重等需要全部行时），否则只加载这些年份的分区；
+    # 只读本地镜像，同步由每次 rerun 开头的 sync_mirror 负责
     try:
-        # 使用 version 作为缓存键实现手动强刷，ttl=0 确保每次读取最新云端
-        df = conn.read(worksheet="Summary", ttl=0)
+        # 读取 + 清洗 (normalize_ledger) 都在 read_ledger 缓存内，版本不变时这里只是缓存命中
+        with perf.span("read_ledger", years=years) as sp:
+            df = read_ledger(mirror.revision, tuple(years) if years is not None else None)
+        if perf.is_enabled():
+            sp.measure(df)
         return df
     except Exception as e:
         st.error(f"数据加载失败: {e}")
-        return pd.DataFrame()
+        return normalize_ledger(pd.DataFrame())
+
+# 每次 rerun 只同步一次，之后的读取都走本地镜像
+sync_mirror()
 
 # --- 3. 侧边栏 ---
 with st.sidebar:
@@ -233,17 +207,24 @@ with st.sidebar:
     
     if st.button("🔄 同步企业微信数据", use_container_width=True):
         with st.spinner("正在从企微抓取数据..."):
-            # 因为函数在 app.py 内部，直接调用即可
-            result = sync_wecom_to_sheets(conn)
+            # 用本地已加载的账本去重，不再为去重下载整表
+            with perf.span("wecom.sync"):
+                current_df = load_data()
+                result = sync_wecom_to_sheets(
+                    store, current_df, on_written=lambda start, rows: publish_write(current_df, start, rows)
+                )
             
             if "✅" in result:
+                # 更新版本号触发主界面刷新
+                st.session_state.table_version += 1
                 st.success(result)
                 st.rerun() # 同步成功后自动刷新页面显示新数据
             else:
                 st.info(result)
 
 # --- 4. 主页面数据加载 ---
-df_main = load_data(version=st.session_state.table_version)
+# 读取分区汇总；明细只在选定年份后加载对应分区（见第 7 节）
+partitions, positions = read_summaries(mirror.revision)
 
 c_title, c_btn = st.columns([5, 2])
 with c_title:
@@ -252,61 +233,28 @@ with c_btn:
     st.write("##") 
     if st.button(L_MAIN["btn_add"], use_container_width=True):
         # 传递 LOCAL_TZ 确保录入时间正确
-        entry_dialog(conn, load_data, LOCAL_TZ)
+        entry_dialog(store, load_data, LOCAL_TZ)
+    if st.button(L_MAIN["btn_import"], use_container_width=True):
+        bulk_import_dialog(store, load_data, LOCAL_TZ)
 
 # 处理弹窗调度
 if st.session_state.get("show_edit_modal", False):
+    # 修正需要完整账本（按编号定位并从该行续算余额）
     edit_dialog(
         st.session_state.edit_target_id, 
-        df_main, 
-        conn, 
+        load_data(), 
+        store, 
         LOCAL_TZ
     )
 
-# --- 5. 数据预处理 (严谨处理：空值不回填) ---
-if not df_main.empty:
-    # 币种对齐，确保统计准确
-    df_main['实际币种'] = df_main['实际币种'].replace(['RMB', '人民币'], 'CNY')
-    
-    # 辅助日期解析函数：仅用于看板统计，不影响原始数据显示
-    def clean_date_for_stats(x):
-        s = str(x).strip()
-        if pd.isna(x) or s == "" or s.lower() == "nan":
-            return pd.NaT # 重点：绝不填充当前时间，确保无数据的单据不参与统计
-        try:
-            dt = pd.to_datetime(s, errors='coerce')
-            if pd.isna(dt): return pd.NaT
-            return dt.replace(tzinfo=None) # 剥离时区以兼容筛选
-        except:
-            return pd.NaT
-
-    # 生成隐藏辅助列，专供看板使用
-    df_main['_calc_date'] = df_main['提交时间'].apply(clean_date_for_stats)
-
-    # 数值列强制类型转换与清洗
-    for col in ['收入(USD)', '支出(USD)', '余额(USD)', '实际金额']:
-        if col in df_main.columns:
-            df_main[col] = (
-                df_main[col]
-                .astype(str)
-                .str.replace(r'[$,\s]', '', regex=True)
-                .pipe(pd.to_numeric, errors='coerce')
-                .fillna(0.0)
-            )
+# --- 5. 数据预处理 ---
+# 清洗与类型转换已在 read_ledger 缓存内由 normalize_ledger 完成（空值不回填），
+# 控件点击引起的重跑不再做任何解析
 
 # --- 6. 生成看板筛选列表 ---
 current_now = datetime.now(LOCAL_TZ)
-try:
-    if not df_main.empty:
-        valid_dates = df_main['_calc_date'].dropna()
-        if not valid_dates.empty:
-            year_list = sorted(valid_dates.dt.year.unique().tolist(), reverse=True)
-        else:
-            year_list = [current_now.year]
-    else:
-        year_list = [current_now.year]
-except:
-    year_list = [current_now.year]
+# 年份列表来自分区汇总（无日期的行不单独成年）
+year_list = sorted((int(y) for y in partitions['年'] if y != UNDATED), reverse=True) or [current_now.year]
     
 month_list = list(range(1, 13))
 
@@ -318,18 +266,29 @@ with st.container(border=True):
         sel_year = st.selectbox("年份", year_list, index=0, label_visibility="collapsed")
     with c2:
         sel_month = st.selectbox("月份", month_list, index=current_now.month - 1, label_visibility="collapsed")
+
+    # 只加载所选年份的分区；月度明细、聚合表与导出都基于它
+    df_main = load_data(years=[sel_year])
+    # 按 (年, 月, 资金性质, 结算账户) 预聚合，月度指标与支出排行都直接查表
+    with perf.span("period_cube"):
+        period_cube = load_period_cube(df_main)
     
     # 筛选当前月份数据
     mask_this_month = (
         (df_main['_calc_date'].dt.year == int(sel_year)) & 
         (df_main['_calc_date'].dt.month == int(sel_month))
     )
-    df_this_month = df_main[mask_this_month].copy()
+    with perf.span("month_filter") as sp:
+        df_this_month = df_main[mask_this_month].copy()
+        sp.set(rows=len(df_this_month))
     
-    # 指标计算
-    tm_inc = df_this_month['收入(USD)'].sum()
-    tm_exp = df_this_month['支出(USD)'].sum()
-    t_balance = df_main['收入(USD)'].sum() - df_main['支出(USD)'].sum()
+    # 指标计算 (查聚合表)
+    with perf.span("cube_month"):
+        tm_inc, tm_exp, exp_stats = cube_month(period_cube, sel_year, sel_month)
+    # 累计结余与年初结转取自分区汇总
+    t_balance = float(partitions['年末结余'].iloc[-1]) if not partitions.empty else 0.0
+    year_part = partitions[partitions['年'] == int(sel_year)]
+    year_opening = float(year_part['年初结余'].iloc[0]) if not year_part.empty else t_balance
 
     with c3:
         st.markdown(f"""
@@ -345,7 +304,7 @@ with st.container(border=True):
     m1, m2, m3 = st.columns(3)
     m1.metric(f"💰 {sel_month}月收入", f"${tm_inc:,.2f}")
     m2.metric(f"📉 {sel_month}月支出", f"${tm_exp:,.2f}")
-    m3.metric("🏦 累计总结余", f"${t_balance:,.2f}")
+    m3.metric("🏦 累计总结余", f"${t_balance:,.2f}", help=f"{sel_year}年初结转 ${year_opening:,.2f}")
 
 # st.divider()
 # 这里的 margin-top: -10px 会把分割线往上“提”，margin-bottom 控制下方间距
@@ -356,27 +315,14 @@ col_l, col_r = st.columns([2, 1])
 with col_l:
     # st.write("🏦 **各账户当前余额 (原币对账)**")
     st.markdown("##### 🏦 **各账户当前余额 (原币对账)**")
-    if not df_main.empty:
-        def calc_bank_balance(group):
-            inc, exp, amt = group['收入(USD)'], group['支出(USD)'], group['实际金额']
-            def get_raw_val(idx):
-                val = amt.loc[idx]
-                if val == 0 or pd.isna(val):
-                    val = inc.loc[idx] if inc.loc[idx] > 0 else exp.loc[idx]
-                return -val if exp.loc[idx] > 0 else val
-            usd_bal = inc.sum() - exp.sum()
-            raw_bal = sum(get_raw_val(idx) for idx in group.index)
-            # 获取该账户最后一次使用的币种
-            cur = group['实际币种'][group['实际币种'] != ""].iloc[-1] if not group['实际币种'].empty else "USD"
-            return pd.Series([usd_bal, raw_bal, cur], index=['USD', 'RAW', 'CUR'])
-
+    if not positions.empty:
         try:
-            df_filtered = df_main[(df_main['结算账户'].notna()) & (df_main['结算账户'] != "") & (df_main['结算账户'] != "-- 请选择 --")].copy()
-            if not df_filtered.empty:
-                acc_stats = df_filtered.groupby('结算账户', group_keys=False).apply(calc_bank_balance).reset_index()
+            # 全部历史的账户头寸来自各分区的汇总表，不需要加载历史明细
+            pos_filtered = positions[(positions['结算账户'] != "") & (positions['结算账户'] != "-- 请选择 --")]
+            if not pos_filtered.empty:
+                with perf.span("account_balances", rows=len(pos_filtered)):
+                    acc_stats = account_balances(pos_filtered)
                 
-                # ✨ 从 logic 导入统一的 ISO_MAP
-                from logic import ISO_MAP 
                 acc_stats['原币种'] = acc_stats['CUR'].map(lambda x: ISO_MAP.get(x, x))
                 
                 # 重命名列名以便应用样式
@@ -396,13 +342,31 @@ with col_l:
                     use_container_width=True, 
                     hide_index=True
                 )
+
+                # 💱 汇兑重估：按估值日汇率重估非美元头寸，列出未实现汇兑损益
+                with st.expander("💱 汇兑重估 (未实现汇兑损益)"):
+                    val_date = st.date_input("估值日期", value=datetime.now(LOCAL_TZ), key="fx_val_date")
+                    with perf.span("fx_revaluation", rows=len(pos_filtered)):
+                        reval = fx_revaluation(pos_filtered, get_rates_on(val_date))
+                    reval = reval[reval['币种'] != "USD"]
+                    if reval.empty:
+                        st.caption("暂无非美元头寸")
+                    else:
+                        st.metric("未实现汇兑损益合计", f"${reval['汇兑损益(USD)'].sum():,.2f}")
+                        st.dataframe(
+                            reval.style.format({
+                                "原币余额": "{:,.2f}", "汇率": "{:,.4f}",
+                                "账面(USD)": "{:,.2f}", "重估(USD)": "{:,.2f}", "汇兑损益(USD)": "{:,.2f}"
+                            }),
+                            use_container_width=True,
+                            hide_index=True
+                        )
         except Exception as e:
             st.error(f"📊 余额计算异常: {e}")
 
 with col_r:
     # st.write(f"🏷️ **{sel_month}月支出排行**")
     st.markdown(f"##### 🏷️ **{sel_month}月支出排行**")
-    exp_stats = df_this_month[df_this_month['支出(USD)'] > 0].groupby('资金性质')[['支出(USD)']].sum().sort_values(by='支出(USD)', ascending=False).reset_index()
     if not exp_stats.empty:
         # ✨ 统一格式：千分符 + 2位小数 (去掉了之前可能的$符号，保持纯净右对齐)
         st.dataframe(
@@ -418,20 +382,17 @@ with col_r:
 # st.markdown('<hr style="margin-top: 0px; margin-bottom: 10px; border: 0; border-top: 1px solid #ddd;">', unsafe_allow_html=True)
 
 # --- 9. 流水明细表 ---
+TABLE_PAGE_SIZES = [50, 100, 200, 500]
+MONEY_COLUMN_CONFIG = {
+    c: st.column_config.NumberColumn(c, format="%,.2f", step=0.01)
+    for c in ["实际金额", "收入(USD)", "支出(USD)", "余额(USD)"]
+}
 if not df_this_month.empty:
     # 💡 排除所有以 "_" 开头的辅助列（比如 _calc_date）
     display_cols = [c for c in df_main.columns if not str(c).startswith('_')] 
     
-    # 倒序展示
-    view_df = df_this_month[display_cols].copy().iloc[::-1]
-    
-    # 使用 .style.format 确保网页显示效果（千分符、右对齐）
-    styled_df = view_df.style.format({
-        "实际金额": "{:,.2f}",
-        "收入(USD)": "{:,.2f}",
-        "支出(USD)": "{:,.2f}",
-        "余额(USD)": "{:,.2f}"
-    })
+    # 导出用完整月度明细（倒序）；表格只渲染当前页
+    view_df = df_this_month[display_cols].iloc[::-1]
 
     table_key = f"main_table_v_{st.session_state.table_version}"
     
@@ -445,89 +406,65 @@ if not df_this_month.empty:
         st.markdown(f"##### 📑 {sel_month}月流水明细")
 
     with btn_col:
-        # 1. 初始化内存缓冲区
-        excel_data = io.BytesIO()
-        
-        # 2. 使用 xlsxwriter 引擎创建 Excel 写入器
-        with pd.ExcelWriter(excel_data, engine='xlsxwriter') as writer:
-            view_df.to_excel(writer, index=False, sheet_name='流水明细')
-            workbook  = writer.book
-            worksheet = writer.sheets['流水明细']
-
-            # 3. 定义基础格式 (宋体, 10号, 带边框)
-            base_style = {'font_name': '宋体', 'font_size': 10, 'border': 1, 'valign': 'vcenter'}
-            header_fmt = workbook.add_format({**base_style, 'bold': True, 'align': 'center', 'fg_color': '#1F4E78', 'font_color': 'white'})
-            left_fmt = workbook.add_format({**base_style, 'align': 'left'})
-            center_fmt = workbook.add_format({**base_style, 'align': 'center'})
-            right_money_fmt = workbook.add_format({**base_style, 'align': 'right', 'num_format': '#,##0.00'})
-
-            # 4. 遍历设置格式
-            for col_idx, col_name in enumerate(view_df.columns):
-                # 写入表头
-                worksheet.write(0, col_idx, col_name, header_fmt)
-
-                # 判断对齐方式
-                if col_name in ["资金性质", "经手人"]:
-                    target_fmt = center_fmt
-                elif col_name in ["实际金额", "收入(USD)", "支出(USD)", "金额(USD)", "余额(USD)"]:
-                    target_fmt = right_money_fmt
-                else:
-                    target_fmt = left_fmt
-
-                # 自动计算列宽 (取内容长度和标题长度的最大值)
-                max_len = max(view_df[col_name].astype(str).map(len).max(), len(str(col_name))) + 4
-                worksheet.set_column(col_idx, col_idx, max_len, target_fmt)
-                
-            # ✨ --- 5. 打印与页面设置 --- ✨
-            # A. 设置为 A4 纸 (9 代表 A4)
-            worksheet.set_paper(9)
-            
-            # B. 设置纸张方向为横向 (1 = 纵向, 0 = 横向，xlsxwriter 默认为纵向)
-            worksheet.set_landscape()
-                
-            # C. 设置页边距 (单位是英寸，1 英寸 ≈ 2.54 厘米)
-            # 左右上下分别设为 0.5 英寸（约 1.27 厘米），这是一个比较平衡的留白
-            worksheet.set_margins(left=0.5, right=0.5, top=0.5, bottom=0.5)
-                
-            # D. 设置自动缩放：将所有列调整在一页宽内打印
-            worksheet.fit_to_pages(1, 0)
-            
-            # E. 页眉防伪
-            # &[L]: 左侧内容, &[C]: 中间内容, &[R]: 右侧内容
-            now_str = datetime.now().strftime('%Y-%m-%d %H:%M')
-            header_text = f'&R&"宋体"&9打印于 {now_str}'
-            worksheet.set_header(header_text)
-        
-            # F. 每一页都打印表头
-            worksheet.repeat_rows(0)
-
-        # 6. 渲染按钮
+        # 按需生成：点击下载时才渲染工作簿，并按 (数据版本, 年, 月) 缓存
+        data_rev = df_main.attrs.get('revision', st.session_state.table_version)
         st.download_button(
             label="📥 导出 Excel",
-            data=excel_data.getvalue(),
+            data=perf.timed("export.month", lambda: month_export(data_rev, sel_year, sel_month, view_df), rows=len(view_df)),
             file_name=f"财务流水_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            mime=XLSX_MIME,
             use_container_width=True
         )
+        # 年度审计导出：汇总表 + 按月/按账户分表
+        with st.popover("📦 年度导出", use_container_width=True):
+            export_by = st.radio("分表方式", list(EXPORT_MODES), format_func=EXPORT_MODES.get, horizontal=True)
+            # df_main 即所选年份的分区，无需再从全量里筛选
+            year_df = df_main
+            st.download_button(
+                label=f"📥 导出 {sel_year} 年度",
+                data=perf.timed("export.year", lambda: year_export(data_rev, sel_year, export_by, year_df), rows=len(year_df), by=export_by),
+                file_name=f"财务流水_{sel_year}_{EXPORT_MODES[export_by]}_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx",
+                mime=XLSX_MIME,
+                use_container_width=True
+            )
 
     # --- 11. 渲染表格 ---
-    event = st.dataframe(
-        styled_df,
-        use_container_width=True,
-        hide_index=True,
-        on_select="rerun", 
-        selection_mode="single-row",
-        key=table_key
-    )
+    # 服务端排序与分页：只序列化当前页；金额格式交给原生 column_config，不再走 Styler
+    p1, p2, p3, p4 = st.columns([2, 1, 1, 1])
+    sort_col = p1.selectbox("排序", [None] + display_cols, format_func=lambda c: "最新在前" if c is None else c,
+                            key="table_sort_col", label_visibility="collapsed")
+    ascending = p2.toggle("升序", value=False, key="table_sort_asc", disabled=sort_col is None)
+    page_size = p3.selectbox("每页", TABLE_PAGE_SIZES, key="table_page_size", label_visibility="collapsed",
+                             format_func=lambda n: f"{n} 条/页")
+    n_pages = max(1, -(-len(view_df) // page_size))
+    page = p4.number_input("页码", min_value=1, max_value=n_pages, value=1, step=1,
+                           key=f"table_page_{sel_year}_{sel_month}_{page_size}", label_visibility="collapsed")
+    with perf.span("page_slice", rows=len(view_df)):
+        page_df, page, n_pages = page_slice(df_this_month[display_cols], sort_col, ascending, page, page_size)
+        # 只把当前页还原为表格格式（金额为元、时间为文本）
+        page_df = to_sheet_frame(page_df)
+    st.caption(f"第 {page}/{n_pages} 页，共 {len(view_df)} 条")
+
+    with perf.span("st.dataframe", rows=len(page_df)):
+        event = st.dataframe(
+            page_df,
+            use_container_width=True,
+            hide_index=True,
+            column_config=MONEY_COLUMN_CONFIG,
+            on_select="rerun", 
+            selection_mode="single-row",
+            # 翻页或换排序后旧的选中行号已无意义，换一个 key 让选择清零
+            key=f"{table_key}_{sort_col}_{ascending}_{page_size}_{page}"
+        )
 
     if event.selection.rows:
         selected_row_idx = event.selection.rows[0]
         # 确保只有在编辑弹窗没打开时，才打开操作弹窗，防止 API 冲突报错
         if not st.session_state.get('show_edit_modal', False):
-            selected_row_data = view_df.iloc[selected_row_idx]
+            selected_row_data = page_df.iloc[selected_row_idx]
             st.session_state.current_active_id = selected_row_data.get("录入编号")
             # 弹出操作窗口
-            row_action_dialog(selected_row_data, df_main, conn)
+            row_action_dialog(selected_row_data, load_data(), store)
     else:
         # 如果没有任何行被选中，确保清理掉残留的 ID
         st.session_state.current_active_id = None
@@ -535,9 +472,17 @@ else:
     # 如果该月份没有数据，显示提示
     st.info(f"💡 {sel_year}年{sel_month}月暂无流水记录。")
 
-
-
-
-
-
-
+# --- 12. 性能面板 ---
+if PERF_PANEL:
+    _perf_record = perf.end_run()
+    if _perf_record:
+        st.session_state._perf_last = _perf_record
+    with st.sidebar.expander("⏱️ 性能面板"):
+        st.toggle("记录本会话各阶段耗时", key="perf_enabled")
+        last = st.session_state.get("_perf_last")
+        if not st.session_state.get("perf_enabled"):
+            st.caption("未开启：计时代码为空操作")
+        elif last:
+            total = last.get("total_ms")
+            st.caption(f"本次重跑{'被中断' if last.get('aborted') else f'共 {total:,.1f} ms'}，日志：{os.path.basename(perf.PERF_LOG_PATH)}")
+            st.dataframe(pd.DataFrame(last["spans"]), use_container_width=True, hide_index=True)
@@ -0,0 +1,308 @@
+"""
+核心逻辑性能基准：合成账本 + 内存版账本存储 (MemoryLedgerStore)，结果写成 JSON 便于版本间对比。
+
+用法：
+    python benchmark.py                         # 默认 1k/10k/100k/1M
+    python benchmark.py --sizes 1k,10k --repeat 5 --out bench.json
+    python benchmark.py --only balance,dashboard --no-memory
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytz
+
+from logic import (
+    STANDARD_COLUMNS, ALL_PROPS, CORE_BIZ, INC_OTHER,
+    normalize_ledger, to_sheet_frame, prepare_new_data, calculate_full_balance, commit_new_entry,
+    account_positions, account_balances, period_cube_source, build_period_cube, update_period_cube, cube_month,
+    OptionIndex,
+)
+from forms import get_historical_options
+from export import build_ledger_xlsx, build_year_xlsx
+from store import MemoryLedgerStore
+
+LOCAL_TZ = pytz.timezone('Asia/Phnom_Penh')
+SIZES = {"1k": 1_000, "10k": 10_000, "100k": 100_000, "1M": 1_000_000}
+
+# =========================================================
+# 1. 合成账本（固定种子，结果可复现）
+# =========================================================
+
+# 账户及其常用币种
+ACCOUNTS = {
+    "ABA银行": "USD", "ACLEDA银行": "USD", "Wing钱包": "USD", "现金-美元": "USD",
+    "现金-瑞尔": "KHR", "工商银行": "CNY", "建设银行": "CNY", "支付宝": "CNY",
+    "中银香港": "HKD", "越南VCB": "VND", "印尼BCA": "IDR", "泰国KBank": "THB",
+}
+# 参考汇率 (1 USD 兑各币种)
+BENCH_RATES = {"USD": 1.0, "CNY": 7.1, "KHR": 4100, "HKD": 7.8, "VND": 25400, "IDR": 16200, "THB": 35.5}
+HANDLERS = ["张三", "李四", "王五", "赵六", "陈七", "刘八", "Sokha", "Dara"]
+TRANSFER_SHARE = 0.05   # 资金结转（成对出现）占比
+PROJECT_COUNT = 400
+
+def _prop_weights():
+    """资金性质权重：日常费用最多，核心业务次之，其余零星"""
+    weights = {p: 1.0 for p in ALL_PROPS if p != "资金结转"}
+    for p in ["管理费用", "差旅费", "工资福利", "网络成本"]:
+        weights[p] = 6.0
+    for p in CORE_BIZ:
+        weights[p] = 3.0
+    props = list(weights)
+    w = np.array([weights[p] for p in props])
+    return props, w / w.sum()
+
+def generate_ledger(n_rows, seed=0, start="2022-01-01"):
+    """
+    生成 n_rows 行、15 列标准表头的账本（与 store.read 的结果同形）：
+    按时间递增，编号 R日期流水号，资金结转为【转出】/【转入】成对的两行，余额逐行累计。
+    约 10% 的 实际金额 为带千分符的字符串，模拟表格里手工录入的格式。
+    """
+    rng = np.random.default_rng(seed)
+    n_pairs = int(n_rows * TRANSFER_SHARE / 2)
+    n_single = n_rows - 2 * n_pairs
+
+    acc_names = np.array(list(ACCOUNTS))
+    acc_curr = np.array([ACCOUNTS[a] for a in acc_names])
+    props, p_w = _prop_weights()
+    props = np.array(props)
+    inc_set = set(CORE_BIZ[:5] + INC_OTHER)
+
+    # 单笔流水
+    acc_idx = rng.integers(0, len(acc_names), n_single)
+    prop = props[rng.choice(len(props), n_single, p=p_w)]
+    is_inc = np.isin(prop, list(inc_set))
+    usd = np.round(rng.lognormal(4.5, 1.2, n_single), 2)
+    curr = acc_curr[acc_idx]
+    raw = np.round(usd * pd.Series(curr).map(BENCH_RATES).to_numpy(), 2)
+    single = pd.DataFrame({
+        "摘要": np.char.add("业务摘要", (np.arange(n_single) % 997).astype(str)),
+        "客户/项目信息": np.where(np.isin(prop, CORE_BIZ),
+                              np.char.add("项目-", rng.integers(0, PROJECT_COUNT, n_single).astype(str)), ""),
+        "结算账户": acc_names[acc_idx],
+        "资金性质": prop,
+        "实际金额": raw,
+        "实际币种": curr,
+        "收入(USD)": np.where(is_inc, usd, 0.0),
+        "支出(USD)": np.where(is_inc, 0.0, usd),
+        "经手人": np.array(HANDLERS)[rng.integers(0, len(HANDLERS), n_single)],
+        "_slot": rng.random(n_single),
+        "_pair": 0,
+    })
+
+    # 资金结转：同币种账户之间的双分录
+    frames = [single]
+    if n_pairs:
+        src = rng.integers(0, len(acc_names), n_pairs)
+        dst = (src + rng.integers(1, len(acc_names), n_pairs)) % len(acc_names)
+        t_usd = np.round(rng.lognormal(6.5, 1.0, n_pairs), 2)
+        t_curr = acc_curr[src]
+        t_raw = np.round(t_usd * pd.Series(t_curr).map(BENCH_RATES).to_numpy(), 2)
+        slot = rng.random(n_pairs)
+        base = {"资金性质": "资金结转", "实际金额": t_raw, "实际币种": t_curr, "经手人": "系统自动结转", "_slot": slot}
+        frames.append(pd.DataFrame({**base, "摘要": "【转出】内部调拨", "客户/项目信息": "内部调拨",
+                                    "结算账户": acc_names[src], "收入(USD)": 0.0, "支出(USD)": t_usd, "_pair": 0}))
+        frames.append(pd.DataFrame({**base, "摘要": "【转入】内部调拨", "客户/项目信息": "内部調拨",
+                                    "结算账户": acc_names[dst], "收入(USD)": t_usd, "支出(USD)": 0.0, "_pair": 1}))
+
+    df = pd.concat(frames, ignore_index=True).sort_values(["_slot", "_pair"], kind="stable").reset_index(drop=True)
+
+    # 时间：均匀铺在约 3 年里（行数多时每天更密）
+    span_min = 3 * 365 * 24 * 60
+    minutes = np.sort(rng.integers(0, span_min, len(df)))
+    ts = pd.Timestamp(start) + pd.to_timedelta(minutes, unit="min")
+    # 转入行与转出行同一时间
+    ts = pd.Series(ts).where(df["_pair"] == 0).ffill()
+    day = ts.dt.strftime("%Y%m%d")
+    serial = df.groupby(day).cumcount() + 1
+    df["录入编号"] = "R" + day + serial.astype(str).str.zfill(3)
+    df["提交时间"] = ts.dt.strftime("%Y-%m-%d %H:%M")
+    df["修改时间"] = ""
+    df["审批/发票单号"] = "INV" + pd.Series(np.arange(len(df)) + 100000).astype(str)
+    df["备注"] = np.where(rng.random(len(df)) < 0.1, "备注", "")
+    df["余额(USD)"] = (df["收入(USD)"] - df["支出(USD)"]).cumsum().round(2)
+
+    # 部分金额是表格里的文本格式
+    as_text = rng.random(len(df)) < 0.1
+    df["实际金额"] = df["实际金额"].astype(object)
+    df.loc[as_text, "实际金额"] = df.loc[as_text, "实际金额"].map(lambda v: f"{v:,.2f}")
+    return df[STANDARD_COLUMNS]
+
+# =========================================================
+# 2. 对照实现（向量化之前的各账户余额算法）
+# =========================================================
+
+def account_balances_v0(df):
+    """原 app.py 的逐组 apply + 逐行 .loc 实现，仅作对照"""
+    def calc_bank_balance(group):
+        inc, exp, amt = group['收入(USD)'], group['支出(USD)'], group['实际金额']
+        def get_raw_val(idx):
+            val = amt.loc[idx]
+            if val == 0 or pd.isna(val):
+                val = inc.loc[idx] if inc.loc[idx] > 0 else exp.loc[idx]
+            return -val if exp.loc[idx] > 0 else val
+        usd_bal = inc.sum() - exp.sum()
+        raw_bal = sum(get_raw_val(idx) for idx in group.index)
+        cur = group['实际币种'][group['实际币种'] != ""].iloc[-1] if not group['实际币种'].empty else "USD"
+        return pd.Series([usd_bal, raw_bal, cur], index=['USD', 'RAW', 'CUR'])
+    return df.groupby('结算账户', group_keys=False, observed=True).apply(calc_bank_balance).reset_index()
+
+# =========================================================
+# 3. 计时与内存
+# =========================================================
+
+def _measure(fn, repeat, memory):
+    """返回 {runs_ms, min_ms, median_ms, peak_mb}；内存单独再跑一次（tracemalloc 会拖慢计时）"""
+    runs = []
+    for _ in range(repeat):
+        gc.collect()
+        t0 = time.perf_counter()
+        fn()
+        runs.append((time.perf_counter() - t0) * 1000)
+    result = {"runs_ms": [round(r, 3) for r in runs], "min_ms": round(min(runs), 3),
+              "median_ms": round(float(np.median(runs)), 3)}
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        fn()
+        result["peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 1e6, 3)
+        tracemalloc.stop()
+    return result
+
+def _sample_entry():
+    return {
+        'sum': "基准测试", 'amt': 710.0, 'curr': "CNY", 'inv': "BENCH-1", 'prop': "管理费用",
+        'note': "", 'hand': "张三", 'conv_usd': 100.0, 'is_transfer': False, 'proj': "",
+        'acc': "工商银行", 'acc_from': None, 'acc_to': None, 'inc_val': 0.0, 'exp_val': 100.0,
+        'converted_usd': 100.0, 'modified_time': "",
+    }
+
+def build_cases(raw, ledger, limits):
+    """
+    各基准项：name -> (组, 函数)。raw 为 store.read 形态，ledger 为 normalize_ledger 之后的缓存形态。
+    极慢的对照实现与 Excel 导出只在行数不超过 limits 时运行。
+    """
+    n = len(ledger)
+    entry = _sample_entry()
+    src = period_cube_source(ledger)
+    cube = build_period_cube(src)
+    last = ledger['_calc_date'].dropna().iloc[-1]
+    month_df = ledger[(ledger['_calc_date'].dt.year == last.year) & (ledger['_calc_date'].dt.month == last.month)]
+    year_df = ledger[ledger['_calc_date'].dt.year == last.year]
+    accounts = ledger[ledger['结算账户'].notna() & (ledger['结算账户'] != "")]
+    sheet = to_sheet_frame(ledger)
+    versioned = ledger.copy()
+    versioned.attrs['revision'] = 1
+
+    store = MemoryLedgerStore(raw)
+
+    def commit_append():
+        commit_new_entry(store, ledger, entry, LOCAL_TZ)
+        # 撤掉追加的行，下一轮仍走追加路径
+        store.truncate(n)
+
+    cases = {
+        "normalize_ledger": ("load", lambda: normalize_ledger(raw)),
+        "prepare_new_data": ("write", lambda: prepare_new_data(ledger, entry, LOCAL_TZ)),
+        "commit_new_entry_append": ("write", commit_append),
+        "calculate_full_balance_full": ("balance", lambda: calculate_full_balance(raw)),
+        "calculate_full_balance_tail": ("balance", lambda: calculate_full_balance(sheet, start_row=max(n - 10, 0))),
+        "dashboard_cube_build": ("dashboard", lambda: build_period_cube(period_cube_source(ledger))),
+        "dashboard_cube_update_tail": ("dashboard", lambda: update_period_cube(cube, removed=src.iloc[-10:], added=src.iloc[-10:])),
+        "dashboard_cube_month": ("dashboard", lambda: cube_month(cube, last.year, last.month)),
+        "account_balances": ("dashboard", lambda: account_balances(account_positions(accounts))),
+        "options_index_build": ("options", lambda: OptionIndex(ledger)),
+        "get_historical_options_warm": ("options", lambda: [get_historical_options(versioned, c)
+                                                            for c in ["结算账户", "经手人", "客户/项目信息"]]),
+    }
+    if n <= limits["slow"]:
+        cases["account_balances_v0"] = ("dashboard", lambda: account_balances_v0(accounts))
+    if n <= limits["export"]:
+        display_cols = [c for c in ledger.columns if not str(c).startswith('_')]
+        cases["export_month_xlsx"] = ("export", lambda: build_ledger_xlsx(month_df[display_cols].iloc[::-1]))
+        cases["export_year_by_account_xlsx"] = ("export", lambda: build_year_xlsx(year_df, by="account"))
+    return cases
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def run(sizes, repeat=3, memory=True, only=None, limits=None, seed=0, log=print):
+    limits = limits or {"slow": 100_000, "export": 100_000}
+    results = []
+    for label in sizes:
+        n = SIZES[label]
+        t0 = time.perf_counter()
+        raw = generate_ledger(n, seed=seed)
+        ledger = normalize_ledger(raw)
+        log(f"[{label}] 生成 {n:,} 行用时 {time.perf_counter() - t0:.1f}s")
+        # 常驻内存：表格原样 (文本/浮点) 与 normalize_ledger 之后的紧凑表示
+        raw_mb = raw.memory_usage(index=False, deep=True).sum() / 1e6
+        ledger_mb = ledger.memory_usage(index=False, deep=True).sum() / 1e6
+        results.append({"size": label, "rows": n, "group": "load", "case": "resident_memory",
+                        "raw_mb": round(raw_mb, 3), "ledger_mb": round(ledger_mb, 3)})
+        log(f"  {'resident_memory':<32} 原样 {raw_mb:.1f} MB -> 紧凑 {ledger_mb:.1f} MB")
+        for name, (group, fn) in build_cases(raw, ledger, limits).items():
+            if only and group not in only and name not in only:
+                continue
+            res = _measure(fn, repeat, memory)
+            results.append({"size": label, "rows": n, "group": group, "case": name, **res})
+            log(f"  {name:<32} {res['median_ms']:>10.2f} ms" + (f"  peak {res['peak_mb']:.1f} MB" if memory else ""))
+        # 新旧对照的加速比
+        by_case = {r["case"]: r for r in results if r["size"] == label}
+        if "account_balances_v0" in by_case and "account_balances" in by_case:
+            speedup = by_case["account_balances_v0"]["median_ms"] / max(by_case["account_balances"]["median_ms"], 1e-9)
+            by_case["account_balances"]["speedup_vs_v0"] = round(speedup, 1)
+            log(f"  account_balances 加速 x{speedup:.1f}")
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="账本核心逻辑性能基准")
+    parser.add_argument("--sizes", default="1k,10k,100k,1M", help="逗号分隔：" + ",".join(SIZES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", default="", help="只跑这些组或用例，逗号分隔 (load,write,balance,dashboard,options,export)")
+    parser.add_argument("--no-memory", action="store_true", help="不做 tracemalloc 内存峰值测量")
+    parser.add_argument("--max-slow-rows", type=int, default=100_000, help="对照实现的最大行数")
+    parser.add_argument("--max-export-rows", type=int, default=100_000, help="Excel 导出的最大行数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="benchmark_results.json")
+    args = parser.parse_args(argv)
+
+    sizes = [s.strip() for s in args.sizes.split(",") if s.strip()]
+    unknown = [s for s in sizes if s not in SIZES]
+    if unknown:
+        parser.error(f"未知规模: {', '.join(unknown)}")
+    only = {s.strip() for s in args.only.split(",") if s.strip()}
+
+    results = run(sizes, repeat=args.repeat, memory=not args.no_memory, only=only,
+                  limits={"slow": args.max_slow_rows, "export": args.max_export_rows}, seed=args.seed,
+                  log=lambda msg: print(msg, file=sys.stderr))
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": _git_commit(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"✅ 结果已写入 {args.out}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
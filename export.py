@@ -0,0 +1,160 @@
+import io
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import pandas as pd
+import streamlit as st
+from logic import CENTS, to_sheet_frame
+
+# =========================================================
+# Excel 导出：只在点击下载时生成，xlsxwriter 流式写入
+# =========================================================
+
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+CENTER_COLUMNS = ["资金性质", "经手人", "笔数"]
+MONEY_FORMAT_COLUMNS = ["实际金额", "收入(USD)", "支出(USD)", "金额(USD)", "余额(USD)", "净额(USD)"]
+
+def _formats(workbook):
+    """基础格式 (宋体, 10号, 带边框)"""
+    base_style = {'font_name': '宋体', 'font_size': 10, 'border': 1, 'valign': 'vcenter'}
+    return {
+        "header": workbook.add_format({**base_style, 'bold': True, 'align': 'center', 'fg_color': '#1F4E78', 'font_color': 'white'}),
+        "left": workbook.add_format({**base_style, 'align': 'left'}),
+        "center": workbook.add_format({**base_style, 'align': 'center'}),
+        "money": workbook.add_format({**base_style, 'align': 'right', 'num_format': '#,##0.00'}),
+    }
+
+def _page_setup(worksheet, printed_at):
+    """A4 横向、0.5 英寸页边距、一页宽、页眉打印时间、每页重复表头"""
+    worksheet.set_paper(9)
+    worksheet.set_landscape()
+    worksheet.set_margins(left=0.5, right=0.5, top=0.5, bottom=0.5)
+    worksheet.fit_to_pages(1, 0)
+    worksheet.set_header(f'&R&"宋体"&9打印于 {printed_at}')
+    worksheet.repeat_rows(0)
+
+def prepare_sheet(sheet_name, df):
+    """
+    工作表的纯数据准备（列宽扫描 + 行物化），不触碰 workbook，可在线程池里并行。
+    返回 (表名, 列名, 列宽, 行列表)
+    """
+    # 列宽取内容长度和标题长度的最大值
+    widths = [
+        max(df[c].astype(str).str.len().max() if len(df) else 0, len(str(c))) + 4
+        for c in df.columns
+    ]
+    # 空值和空串都不写单元格（沿用列格式），稀疏列不再逐格走写入分派
+    values = df.astype(object)
+    rows = list(values.where(values.notna() & (values != ""), None).itertuples(index=False, name=None))
+    return sheet_name, list(df.columns), widths, rows
+
+def write_prepared_sheet(workbook, prepared, fmts, printed_at):
+    """
+    把 prepare_sheet 的结果写成一个工作表。constant_memory 模式要求按行顺序写，
+    所以列格式和列宽先设好，再逐行 write_row。
+    """
+    sheet_name, columns, widths, rows = prepared
+    worksheet = workbook.add_worksheet(sheet_name)
+    for col_idx, col_name in enumerate(columns):
+        if col_name in CENTER_COLUMNS:
+            target_fmt = fmts["center"]
+        elif col_name in MONEY_FORMAT_COLUMNS:
+            target_fmt = fmts["money"]
+        else:
+            target_fmt = fmts["left"]
+        worksheet.set_column(col_idx, col_idx, widths[col_idx], target_fmt)
+        worksheet.write(0, col_idx, col_name, fmts["header"])
+
+    for row_idx, row in enumerate(rows, start=1):
+        worksheet.write_row(row_idx, 0, row)
+
+    _page_setup(worksheet, printed_at)
+    return worksheet
+
+def write_ledger_sheet(workbook, sheet_name, df, fmts, printed_at):
+    """把 df 写成一个工作表"""
+    return write_prepared_sheet(workbook, prepare_sheet(sheet_name, df), fmts, printed_at)
+
+def build_ledger_xlsx(df, sheet_name="流水明细"):
+    """单工作表导出（df 为 normalize_ledger 之后的账本，写出前还原为表格格式），返回 xlsx 字节"""
+    import xlsxwriter  # 首次导出时才加载
+    buf = io.BytesIO()
+    printed_at = datetime.now().strftime('%Y-%m-%d %H:%M')
+    # constant_memory：每写完一行即落盘到临时文件，大表导出内存不随行数增长
+    workbook = xlsxwriter.Workbook(buf, {'constant_memory': True})
+    write_ledger_sheet(workbook, sheet_name, to_sheet_frame(df), _formats(workbook), printed_at)
+    workbook.close()
+    return buf.getvalue()
+
+@st.cache_data(max_entries=12, show_spinner=False)
+def month_export(revision, year, month, _view_df):
+    """按 (数据版本, 年, 月) 缓存的月度明细导出；数据变化后版本号随之变化"""
+    return build_ledger_xlsx(_view_df)
+
+# --- 年度审计导出：汇总表 + 按月/按账户分表 ---
+EXPORT_MODES = {"month": "按月分表", "account": "按账户分表"}
+SUMMARY_SHEET = "汇总"
+EXPORT_WORKERS = 4
+_BAD_SHEET_CHARS = re.compile(r'[\[\]:*?/\\]')
+
+def _sheet_name(name, used):
+    """Excel 表名：去掉非法字符、最长 31 字符、不可重复"""
+    base = _BAD_SHEET_CHARS.sub("_", str(name).strip() or "未填写")[:31]
+    candidate, n = base, 2
+    while candidate in used:
+        suffix = f"({n})"
+        candidate, n = base[:31 - len(suffix)] + suffix, n + 1
+    used.add(candidate)
+    return candidate
+
+def split_ledger(df, by):
+    """按月 (1月..12月) 或按结算账户拆分，返回 [(分组名, 子表)]，保持账本原行序"""
+    if by == "month":
+        keys = df['_calc_date'].dt.month
+        return [(f"{int(m)}月", g) for m, g in df.groupby(keys, sort=True)]
+    keys = df['结算账户'].astype(object).fillna("").astype(str).str.strip()
+    return [(k or "未填写", g) for k, g in df.groupby(keys, sort=True)]
+
+def summary_frame(groups):
+    """汇总表：每个分组的笔数、收支与净额，末行合计（按分求和后换算为元）"""
+    summary = pd.DataFrame({
+        "分组": [name for name, _ in groups],
+        "笔数": [len(g) for _, g in groups],
+        "收入(USD)": [g['收入(USD)'].sum() / CENTS for _, g in groups],
+        "支出(USD)": [g['支出(USD)'].sum() / CENTS for _, g in groups],
+    })
+    summary["净额(USD)"] = summary["收入(USD)"] - summary["支出(USD)"]
+    total = summary[["笔数", "收入(USD)", "支出(USD)", "净额(USD)"]].sum()
+    summary.loc[len(summary)] = {"分组": "合计", **total.to_dict()}
+    return summary
+
+def build_year_xlsx(df, by="month", max_workers=EXPORT_WORKERS):
+    """
+    年度导出：第一个工作表为汇总，其后每月/每个账户一个工作表。
+    各表的数据准备（还原为表格格式 + 列宽扫描 + 行物化）互不依赖，在线程池里并行；同一 workbook 不能多线程写，
+    写入阶段按顺序流式落盘 (constant_memory)。
+    """
+    groups = split_ledger(df, by)
+    used = {SUMMARY_SHEET}
+    summary = summary_frame(groups)
+    # (表名, 生成表格格式数据的函数)；分组的格式还原放进线程池里做
+    jobs = [(SUMMARY_SHEET, lambda: summary)]
+    jobs += [(_sheet_name(name, used), lambda g=g: to_sheet_frame(g)) for name, g in groups]
+
+    import xlsxwriter
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        prepared = pool.map(lambda job: prepare_sheet(job[0], job[1]()), jobs)  # 结果按提交顺序返回
+
+        buf = io.BytesIO()
+        printed_at = datetime.now().strftime('%Y-%m-%d %H:%M')
+        workbook = xlsxwriter.Workbook(buf, {'constant_memory': True})
+        fmts = _formats(workbook)
+        for sheet in prepared:
+            write_prepared_sheet(workbook, sheet, fmts, printed_at)
+        workbook.close()
+    return buf.getvalue()
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def year_export(revision, year, by, _year_df):
+    """按 (数据版本, 年, 分表方式) 缓存的年度审计导出"""
+    return build_year_xlsx(_year_df, by=by)
@@ -1,32 +1,43 @@
 import streamlit as st
 import pandas as pd
 import time
+import perf
 from datetime import datetime
-from logic import ALL_PROPS, CORE_BIZ, INC_OTHER, EXP_OTHER, prepare_new_data, calculate_full_balance, get_dynamic_options
+from logic import ALL_PROPS, CORE_BIZ, INC_OTHER, EXP_OTHER, CENTS, commit_new_entry, commit_row_change, get_dynamic_options, to_sheet_frame
+from logic import get_ledger_index, get_option_index, get_rates_on, get_rate_status, BULK_COLUMNS, validate_bulk_entries, commit_bulk_entries
+from mirror import publish_write
 
 # --- 4. 录入模块 ---
-def get_historical_options(df, col):
+def get_historical_options(df, col, ranked=False):
     """
     专门从 DataFrame 中提取已有的选项（如结算账户、经手人）
+    去重排序结果来自按数据版本缓存的选项索引；ranked=True 时常用的排在前面
     """
     if col not in df.columns: 
         return ["-- 请选择 --", "➕ 新增..."]
-    # 提取去重、排序、排除空值
-    existing = sorted([str(v) for v in df[col].unique() if v and str(v).strip() != "" and v not in ["-- 请选择 --", "➕ 新增..."]])
+    existing = get_option_index(df).options(col, ranked=ranked)
     return ["-- 请选择 --"] + existing + ["➕ 新增..."]
 
+def show_rate_freshness():
+    """汇率新鲜度提示：已存汇率立即可用，过期时后台刷新，不阻塞弹窗"""
+    status = get_rate_status()
+    if status["fetched_at"] is None:
+        msg = "⚠️ 尚未取到实时汇率，当前为保底汇率"
+    else:
+        age_min = int(status["age"] // 60)
+        age_txt = f"{age_min} 分钟前" if age_min < 60 else f"{age_min // 60} 小时前"
+        msg = f"{'⏳' if status['stale'] else '🟢'} 汇率更新于 {age_txt}"
+    if status["refreshing"]:
+        msg += "，后台刷新中…"
+    elif status["stale"] and status["error"] is not None:
+        msg += "（刷新失败，稍后自动重试）"
+    st.caption(msg)
+
 @st.dialog("➕ 新增流水录入", width="large")
-def entry_dialog(conn, load_data, LOCAL_TZ):
-    from logic import get_live_rates
-    # 1. 获取汇率
-    try:
-        live_rates = get_live_rates()
-        if not live_rates or not isinstance(live_rates, dict):
-            live_rates = {"USD": 1.0, "CNY": 6.88}
-    except Exception as e:
-        live_rates = {"USD": 1.0, "CNY": 6.88}
-    
+def entry_dialog(store, load_data, LOCAL_TZ):
+    # 1. 汇率按业务时间从本地汇率库查询（见下方业务时间输入），打开弹窗不等待网络
     # 2. 统一获取选项，避免后续重复赋值覆盖
+    # 与主页面使用同一版本的缓存数据，提交时再核对云端末尾是否变化
     df = load_data()
     opts = get_dynamic_options()
     curr_list = ["USD", "CNY", "HKD", "KHR", "VND", "IDR", "THB"] # 显式定义你需要的币种
@@ -36,13 +47,14 @@ def entry_dialog(conn, load_data, LOCAL_TZ):
     st.markdown("""<style>hr{margin-top:-5px!important;margin-bottom:10px!important;}.stTextArea textarea{height:68px!important;}</style>""", unsafe_allow_html=True)
 
     # 4. 顶部结余显示
-    current_balance = df['余额(USD)'].iloc[-1] if not df.empty else 0
+    current_balance = df['余额(USD)'].iloc[-1] / CENTS if not df.empty else 0
     st.write(f"💡 当前总结余: **${current_balance:,.2f}**")
     
     # 1. 摘要与时间
     c1, c2 = st.columns(2)
     val_sum = c1.text_input("摘要内容 :red[*]", placeholder="请输入流水说明")
     val_time = c2.date_input("业务时间", value=datetime.now(LOCAL_TZ))
+    live_rates = get_rates_on(val_time)
 
     # 2. 金额、币种、汇率
     r2_c1, r2_c2, r2_c3 = st.columns(3)
@@ -57,10 +69,13 @@ def entry_dialog(conn, load_data, LOCAL_TZ):
         "实时汇率", 
         value=current_rate,  # 直接用上面算好的变量
         format="%.4f",
-        # 关键：加上币种作为 key 的一部分，这样切换币种时，输入框会被强制刷新！
-        key=f"rate_input_{target_key}" 
+        # 关键：加上币种和业务日期作为 key 的一部分，切换币种或日期时，输入框会被强制刷新！
+        key=f"rate_input_{target_key}_{val_time}",
+        help=f"💡 {val_time} 适用汇率"
     )
     
+    show_rate_freshness()
+
     # 实时换算显示
     converted_usd = round(val_amt / val_rate, 2) if val_rate != 0 else 0
     st.info(f"💰 换算后金额：$ {converted_usd:,.2f} USD")
@@ -88,7 +103,8 @@ def entry_dialog(conn, load_data, LOCAL_TZ):
 
     # 5. 客户或项目信息
     proj_label = "📍 客户/项目信息 (必填)" if is_req else "客户/项目信息 (选填)"
-    sel_proj = st.selectbox(proj_label, options=get_historical_options(df, "客户/项目信息"))
+    # 新录入多半沿用常用项目，按使用次数排序
+    sel_proj = st.selectbox(proj_label, options=get_historical_options(df, "客户/项目信息", ranked=True))
     val_proj = st.text_input("✍️ 录入新客户/项目", placeholder="项目名称...") if sel_proj == "➕ 新增..." else sel_proj
 
     val_note = st.text_area("备注", height=68)
@@ -124,9 +140,6 @@ def entry_dialog(conn, load_data, LOCAL_TZ):
         
         with st.spinner("正在同步至云端..."):
             try:
-                # 重新加载最新数据（带版本控制）
-                current_df = load_data(version=st.session_state.table_version + 1)
-                
                 # --- C. 构建入库字典 ---
                 entry_data = {
                     'sum': val_sum, 
@@ -148,14 +161,15 @@ def entry_dialog(conn, load_data, LOCAL_TZ):
                     'modified_time': ""
                 }
 
-                # 调用处理函数（逻辑锁会在 calculate_full_balance 中剔除 _calc_date）
-                full_df, new_ids = prepare_new_data(current_df, entry_data, LOCAL_TZ)
-                
-                # 执行更新
-                conn.update(worksheet="Summary", data=full_df)
+                # 只追加新行；云端末尾已变化时自动回退为整表重算重写
+                with perf.span("commit_new_entry") as sp:
+                    write_mode, new_ids = commit_new_entry(
+                        store, df, entry_data, LOCAL_TZ, on_written=lambda start, rows: publish_write(df, start, rows)
+                    )
+                    sp.set(mode=write_mode, rows=len(new_ids))
                 
                 st.toast("记账成功！数据已实时同步", icon="💰")
-                st.cache_data.clear()
+                # 改动已直接应用到共享镜像并推进版本号，汇率等其他缓存不受影响
                 st.session_state.table_version += 1
                 st.rerun()
                 
@@ -165,19 +179,77 @@ def entry_dialog(conn, load_data, LOCAL_TZ):
     if col_can.button("🗑️ 取消返回", use_container_width=True):
         st.rerun()
 
+# --- 4b. 批量导入模块 ---
+@st.dialog("📥 批量导入流水", width="large")
+def bulk_import_dialog(store, load_data, LOCAL_TZ):
+    live_rates = get_rates_on(None)
+
+    st.caption("按模板填写后上传 CSV/XLSX；汇率留空则按实时汇率折算，资金结转需填写转出/转入账户。")
+    show_rate_freshness()
+    template_csv = pd.DataFrame(columns=BULK_COLUMNS).to_csv(index=False).encode("utf-8-sig")
+    st.download_button("📄 下载导入模板", template_csv, file_name="导入模板.csv", mime="text/csv")
+
+    up = st.file_uploader("选择文件", type=["csv", "xlsx"])
+    if up is None:
+        return
+
+    try:
+        if up.name.lower().endswith(".xlsx"):
+            raw = pd.read_excel(up, dtype=str)
+        else:
+            raw = pd.read_csv(up, dtype=str, encoding="utf-8-sig")
+    except ImportError:
+        st.error("❌ 读取 Excel 需要安装 openpyxl，请改用 CSV 导入"); return
+    except Exception as e:
+        st.error(f"❌ 文件读取失败: {e}"); return
+
+    missing = [c for c in ["摘要", "原币金额", "资金性质"] if c not in raw.columns]
+    if missing:
+        st.error(f"❌ 缺少必要列: {', '.join(missing)}"); return
+
+    with perf.span("bulk.validate", rows=len(raw)):
+        entries, errors = validate_bulk_entries(raw)
+    bad = errors != ""
+    preview = entries.assign(校验结果=errors.where(bad, "✅"))
+    st.dataframe(preview, use_container_width=True, hide_index=True, height=300)
+
+    if bad.any():
+        st.error(f"❌ 共 {len(entries)} 行，其中 {int(bad.sum())} 行校验未通过，请修正后重新上传")
+        return
+    if entries.empty:
+        st.warning("⚠️ 文件中没有数据行"); return
+
+    st.success(f"✅ 共 {len(entries)} 行校验通过")
+    if st.button("🚀 确认导入", type="primary", use_container_width=True):
+        with st.spinner("正在同步至云端..."):
+            try:
+                df = load_data()
+                # 全部行一次写入，余额只续算一次
+                with perf.span("bulk.commit") as sp:
+                    write_mode, new_ids = commit_bulk_entries(
+                        store, df, entries, live_rates, LOCAL_TZ, on_written=lambda start, rows: publish_write(df, start, rows)
+                    )
+                    sp.set(mode=write_mode, rows=len(new_ids))
+                st.toast(f"成功导入 {len(new_ids)} 条流水", icon="📥")
+                st.session_state.table_version += 1
+                st.rerun()
+            except Exception as e:
+                st.error(f"❌ 写入失败: {e}")
+
 # --- 5. 数据修正模块 ---
 @st.dialog("🛠️ 数据修正", width="large")
-def edit_dialog(target_id, full_df, conn, LOCAL_TZ):
-    try:
-        old = full_df[full_df["录入编号"] == target_id].iloc[0]
-    except Exception:
+def edit_dialog(target_id, full_df, store, LOCAL_TZ):
+    # 通过编号索引直接定位行，不再整列扫描
+    pos = get_ledger_index(full_df).position(target_id)
+    if pos is None:
         st.session_state.show_edit_modal = False
         st.rerun()
         return
+    # 取出的这一行还原为表格格式（金额为元、时间为文本）再展示
+    old = to_sheet_frame(full_df.iloc[[pos]]).iloc[0]
 
-    # 1. 获取动态选项（这里仍需调用一下函数获取最新 live_rates 和 opts）
-    from logic import get_live_rates # 仅保留这一个必须动态获取的
-    live_rates = get_live_rates()
+    # 1. 获取动态选项；参考汇率按原记录的录入日期从本地汇率库查询
+    live_rates = get_rates_on(str(old.get("提交时间", "")) or None)
     opts = get_dynamic_options()
     curr_list = ["USD", "CNY", "HKD", "KHR", "VND", "IDR", "THB"]
     prop_list = opts.get("properties", ALL_PROPS)
@@ -217,6 +289,7 @@ def edit_dialog(target_id, full_df, conn, LOCAL_TZ):
         help=f"💡 当前实时参考汇率: {live_ref:.4f}"
     )
     
+    show_rate_freshness()
     u_usd_val = round(u_ori_amt / u_rate, 2) if u_rate != 0 else 0
     st.success(f"💰 折算后金额：$ {u_usd_val:,.2f} USD")
     # st.markdown('<hr>', unsafe_allow_html=True)
@@ -271,30 +344,35 @@ def edit_dialog(target_id, full_df, conn, LOCAL_TZ):
             st.error("摘要不能为空")
             return
         try:
-            new_df = full_df.copy()
-            idx = new_df[new_df["录入编号"] == target_id].index[0]
-            new_df.at[idx, "摘要"] = u_sum
-            new_df.at[idx, "客户/项目信息"] = u_proj
-            new_df.at[idx, "结算账户"] = u_acc
-            new_df.at[idx, "审批/发票单号"] = u_inv
-            new_df.at[idx, "资金性质"] = u_prop
-            new_df.at[idx, "实际金额"] = float(u_ori_amt)
-            new_df.at[idx, "实际币种"] = u_curr
-            new_df.at[idx, "汇率"] = float(u_rate) # 存回汇率
-            new_df.at[idx, "经手人"] = u_hand
-            new_df.at[idx, "备注"] = u_note
-            new_df.at[idx, "修改时间"] = datetime.now(LOCAL_TZ).strftime('%Y-%m-%d %H:%M')
-            
             is_income = (u_prop in CORE_BIZ[:5] or u_prop in INC_OTHER)
-            new_df.at[idx, "收入(USD)"] = float(u_usd_val) if is_income else 0.0
-            new_df.at[idx, "支出(USD)"] = float(u_usd_val) if not is_income else 0.0
-            
-            new_df = calculate_full_balance(new_df)
-            conn.update(worksheet="Summary", data=new_df)
+            edits = {
+                "摘要": u_sum, "客户/项目信息": u_proj, "结算账户": u_acc, "审批/发票单号": u_inv,
+                "资金性质": u_prop, "实际金额": float(u_ori_amt), "实际币种": u_curr,
+                "汇率": float(u_rate),  # 存回汇率
+                "经手人": u_hand, "备注": u_note,
+                "修改时间": datetime.now(LOCAL_TZ).strftime('%Y-%m-%d %H:%M'),
+                "收入(USD)": float(u_usd_val) if is_income else 0.0,
+                "支出(USD)": float(u_usd_val) if not is_income else 0.0,
+            }
+
+            def apply_edit(sheet_df, idx):
+                # 表格格式的片段逐格修改（category 列不接受新取值）
+                for col, val in edits.items():
+                    sheet_df.at[idx, col] = val
+                return sheet_df
+
+            # 先核对存储里该编号仍在原位置，再只回写被修改行及其后余额有变化的尾部；不一致时整表重写
+            with perf.span("edit.commit_row_change") as sp:
+                write_mode = commit_row_change(
+                    store, full_df, target_id, apply_edit, on_written=lambda start, rows: publish_write(full_df, start, rows)
+                )
+                sp.set(mode=write_mode)
+            if write_mode is None:
+                st.error("❌ 记录已不存在，请刷新后重试")
+                return
             
             st.session_state.show_edit_modal = False
             st.session_state.table_version += 1
-            st.cache_data.clear()
             st.success("✅ 修正成功！")
             time.sleep(0.8)
             st.rerun()
@@ -308,7 +386,7 @@ def edit_dialog(target_id, full_df, conn, LOCAL_TZ):
 
 # --- 🎯 表格行操作模块 ---
 @st.dialog("🎯 账目操作", width="small")
-def row_action_dialog(row_data, full_df, conn):
+def row_action_dialog(row_data, full_df, store):
     rec_id = row_data["录入编号"]
     st.write(f"**记录编号：** `{rec_id}`")
     st.write(f"**内容预览：** {row_data.get('摘要','')}")
@@ -342,26 +420,26 @@ def row_action_dialog(row_data, full_df, conn):
         
         if cc1.button("✅ 确定删除", use_container_width=True):
             try:
-                updated_df = full_df[full_df["录入编号"] != rec_id].copy()
-                from logic import calculate_full_balance
-                updated_df = calculate_full_balance(updated_df)
-                conn.update(worksheet="Summary", data=updated_df)
+                # 被删行之前的余额不受影响：去掉该行后从其原位置续算，核对与回退同修正
+                with perf.span("delete.commit_row_change") as sp:
+                    write_mode = commit_row_change(
+                        store, full_df, rec_id, lambda sheet_df, idx: sheet_df.drop(idx),
+                        on_written=lambda start, rows: publish_write(full_df, start, rows)
+                    )
+                    sp.set(mode=write_mode)
+                if write_mode is None:
+                    st.error("❌ 记录已不存在，请刷新后重试"); return
                 
                 if del_confirm_key in st.session_state:
                     del st.session_state[del_confirm_key]
                 
                 st.session_state.table_version += 1
-                st.cache_data.clear()
                 st.rerun()
             except Exception as e:
                 st.error(f"❌ 删除失败，请检查网络: {e}")
         
         if cc2.button("取消", use_container_width=True):
             st.session_state[del_confirm_key] = False
+            # 版本号变了表格 key 随之变化，选中项被清空，防止弹窗“阴魂不散”
             st.session_state.table_version += 1
-            # 强制清空表格选中项，防止弹窗“阴魂不散”
-            table_key = f"main_table_v_{st.session_state.table_version}"
-            if table_key in st.session_state:
-                # 重置选择状态
-                st.session_state[table_key] = {"selection": {"rows": [], "columns": []}}
             st.rerun()
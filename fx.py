@@ -0,0 +1,159 @@
+import os
+import sqlite3
+import threading
+import time
+from datetime import date, datetime
+import streamlit as st
+
+# =========================================================
+# 汇率库 (SQLite)：每天一份快照，按业务日期查询，后台刷新
+# =========================================================
+
+RATES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".fx_rates.sqlite")
+RATES_API = "https://open.er-api.com/v6/latest/USD"
+REQUEST_TIMEOUT = 5
+RATES_TTL = 3600     # 最新快照超过 1 小时即视为过期，下次查询时后台刷新
+RETRY_SECONDS = 300  # 刷新失败后的重试间隔，断网时不反复发请求
+
+# 保底汇率（1 USD 兑各币种）：库里还没有任何快照、或某币种缺失时使用
+DEFAULT_RATES = {
+    "USD": 1.0,
+    "CNY": 6.88,
+    "KHR": 4015,
+    "VND": 25750,
+    "HKD": 7.82,
+    "IDR": 15600,
+    "THB": 31.14
+}
+
+def _day(d):
+    """date/datetime/字符串 统一为 YYYY-MM-DD"""
+    if isinstance(d, str):
+        return d[:10]
+    if isinstance(d, datetime):
+        d = d.date()
+    return (d or date.today()).isoformat()
+
+class RateStore:
+    """
+    USD 基准汇率的按日快照。查询只读本地库（进程内再缓存一层），
+    从不在调用方线程里访问网络；取数由 refresh_async 在后台线程完成。
+    """
+
+    def __init__(self, path=RATES_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._refresh_thread = None
+        self._last_attempt = 0.0
+        self._cache = {}  # day -> 完整汇率字典
+        self.last_error = None
+        with self._db() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS rates ("
+                "day TEXT, currency TEXT, rate REAL, fetched_at REAL, "
+                "PRIMARY KEY (day, currency))"
+            )
+
+    def _db(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    # --- 读 ---
+    def rates_on(self, day=None):
+        """
+        业务日期当天适用的汇率：取不晚于该日的最近一份快照，
+        早于最早快照时取最早一份；快照缺失的币种用保底汇率补齐。
+        """
+        key = _day(day)
+        if key in self._cache:
+            return dict(self._cache[key])
+        with self._db() as db:
+            snap_day = db.execute("SELECT MAX(day) FROM rates WHERE day <= ?", (key,)).fetchone()[0]
+            if snap_day is None:
+                snap_day = db.execute("SELECT MIN(day) FROM rates").fetchone()[0]
+            rows = db.execute("SELECT currency, rate FROM rates WHERE day = ?", (snap_day,)).fetchall() if snap_day else []
+        rates = {**DEFAULT_RATES, **{c: r for c, r in rows if c in DEFAULT_RATES}}
+        # 只缓存已有当天快照的历史日期；今天及以后的结果会随刷新变化
+        if snap_day == key and key < _day(None):
+            self._cache[key] = rates
+        return dict(rates)
+
+    def latest(self):
+        return self.rates_on(None)
+
+    def has_snapshot(self, day=None):
+        with self._db() as db:
+            return db.execute("SELECT 1 FROM rates WHERE day = ? LIMIT 1", (_day(day),)).fetchone() is not None
+
+    def last_fetched_at(self):
+        """最近一次成功取数的时间戳；从未取到过返回 None"""
+        with self._db() as db:
+            return db.execute("SELECT MAX(fetched_at) FROM rates").fetchone()[0]
+
+    def status(self):
+        """
+        汇率新鲜度，供弹窗展示：
+        fetched_at 最近取数时间（None 表示一直在用保底汇率），age 距今秒数，
+        stale 是否超过 RATES_TTL，refreshing 后台是否正在刷新，error 最近一次刷新错误
+        """
+        fetched_at = self.last_fetched_at()
+        age = None if fetched_at is None else max(0.0, time.time() - fetched_at)
+        return {
+            "fetched_at": fetched_at,
+            "age": age,
+            "stale": age is None or age > RATES_TTL,
+            "refreshing": self._refresh_thread is not None and self._refresh_thread.is_alive(),
+            "error": self.last_error,
+        }
+
+    # --- 写 ---
+    def save_snapshot(self, day, rates, fetched_at=None):
+        """写入（覆盖）某天的快照"""
+        key = _day(day)
+        fetched_at = fetched_at or time.time()
+        with self._db() as db:
+            db.executemany(
+                "INSERT OR REPLACE INTO rates (day, currency, rate, fetched_at) VALUES (?, ?, ?, ?)",
+                [(key, c, float(r), fetched_at) for c, r in rates.items() if c in DEFAULT_RATES and r and r > 0],
+            )
+        self._cache.pop(key, None)
+
+    # --- 刷新 ---
+    def refresh(self):
+        """同步拉取一次最新汇率并存为当天快照；只在后台线程里调用"""
+        import requests  # 只在后台刷新线程里用到，不拖慢启动
+        with self._lock:
+            resp = requests.get(RATES_API, timeout=REQUEST_TIMEOUT)
+            resp.raise_for_status()
+            payload = resp.json()
+            api_rates = payload.get("rates", {})
+            rates = {c: float(v) for c, v in api_rates.items() if c in DEFAULT_RATES and isinstance(v, (int, float)) and v > 0}
+            if not rates:
+                raise ValueError("汇率接口未返回可用币种")
+            self.save_snapshot(date.today(), rates)
+            self.last_error = None
+            return rates
+
+    def refresh_async(self):
+        """
+        stale-while-revalidate：调用方立即拿已存汇率，
+        最新快照过期（或今天还没有快照）时在后台刷新，不等待网络
+        """
+        fresh = self.has_snapshot(None) and not self.status()["stale"]
+        if fresh or time.time() - self._last_attempt < RETRY_SECONDS:
+            return False
+        if self._refresh_thread is None or not self._refresh_thread.is_alive():
+            self._last_attempt = time.time()
+            def _run():
+                try:
+                    self.refresh()
+                except Exception as e:
+                    self.last_error = e
+                    print(f"⚠️ 汇率刷新失败，继续使用已存汇率: {e}")
+            self._refresh_thread = threading.Thread(target=_run, daemon=True)
+            self._refresh_thread.start()
+        return True
+
+@st.cache_resource
+def get_rate_store(path=RATES_PATH):
+    """进程内共享同一个汇率库对象"""
+    return RateStore(path)
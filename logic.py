@@ -1,7 +1,10 @@
-import requests  # ✨ 必须加上这个，否则 get_live_rates 会报错
 import streamlit as st # ✨ 必须加上这个，否则 @st.cache_data 会报错
+import numpy as np
 import pandas as pd
+import threading
 from datetime import datetime
+import perf
+from fx import get_rate_store
 
 # =========================================================
 # 1. 核心业务常量 (新增币种定义)
@@ -31,61 +34,345 @@ def get_dynamic_options():
         "properties": ALL_PROPS
     }
 
-# --- 实时汇率 ---
-@st.cache_data(ttl=3600)
+# --- 汇率 ---
+# 汇率来自本地按日快照库，查询不走网络；当天快照缺失时在后台刷新
+def get_rates_on(day=None):
+    """业务日期适用的汇率 (1 USD 兑各币种)，day 为空表示今天"""
+    store = get_rate_store()
+    store.refresh_async()
+    return store.rates_on(day)
+
 def get_live_rates():
-    # 1. 预设完整的币种模板和默认汇率
-    final_rates = {
-        "USD": 1.0, 
-        "CNY": 6.88, 
-        "KHR": 4015,
-        "VND": 25750, 
-        "HKD": 7.82, 
-        "IDR": 15600,
-        "THB": 31.14
-    }
-    
-    try:
-        # 2. 尝试获取 API 实时数据
-        response = requests.get("https://open.er-api.com/v6/latest/USD", timeout=5)
-        if response.status_code == 200:
-            api_data = response.json().get("rates", {})
-            
-            # 3. 只有当 API 返回的数据里有我们要的币种，才更新 final_rates
-            # API 里没有的币种（比如它漏给了 HKD），会保持上面 7.82 的默认值
-            for curr in final_rates.keys():
-                if curr in api_data:
-                    val = api_data[curr]
-                    if isinstance(val, (int, float)) and val > 0:
-                        final_rates[curr] = float(val)
-            
-            # 4. 重点：更新完后直接返回这个完整的字典
-            return final_rates
-            
-    except Exception as e:
-        print(f"⚠️ API请求异常，已自动切换至本地保底汇率: {e}")
-    
-    # 5. 重点：如果 API 请求失败（网络不通），依然返回上面那组保底数据
-    # 这样 forms.py 拿到的 HKD 至少是 7.82，绝对不会是 1.0
-    return final_rates
+    """最新汇率；保留原函数名供各处调用"""
+    return get_rates_on(None)
+
+def get_rate_status():
+    """汇率新鲜度（取数时间、是否过期、是否在后台刷新），见 RateStore.status"""
+    return get_rate_store().status()
     
 # =========================================================
 # 2. 数据处理核心函数
 # =========================================================
 
-def prepare_new_data(current_df, v, LOCAL_TZ):
+# 账本标准 15 列表头（写回云端时的列顺序）
+STANDARD_COLUMNS = [
+    "录入编号", "提交时间", "修改时间", "摘要", "客户/项目信息", "结算账户", 
+    "审批/发票单号", "资金性质", "实际金额", "实际币种", 
+    "收入(USD)", "支出(USD)", "余额(USD)", "经手人", "备注"
+]
+MONEY_COLUMNS = ['实际金额', '收入(USD)', '支出(USD)', '余额(USD)']
+
+# 币种别名统一 (统计口径)
+CURRENCY_ALIASES = {"RMB": "CNY", "人民币": "CNY"}
+# 低基数文本列，内存中存为 category
+CATEGORY_COLUMNS = ['资金性质', '实际币种', '结算账户', '经手人', '客户/项目信息']
+# 时间列：表格里的文本格式；内存中按此格式无损时存为 datetime64
+TIME_COLUMNS = ['提交时间', '修改时间']
+TIME_FORMAT = "%Y-%m-%d %H:%M"
+# 金额列在内存中存为 int64 分（余额累加、分组求和都是精确整数运算），只在读写边界与元互转
+CENTS = 100
+
+def clean_money(series):
+    """把带 $、千分位逗号、空格的金额列清洗为 float64，无法解析的记为 0"""
+    if pd.api.types.is_numeric_dtype(series):
+        return series.astype(float).fillna(0.0)
+    return pd.to_numeric(
+        series.astype(str).str.replace(r'[$,\s]', '', regex=True), 
+        errors='coerce'
+    ).fillna(0.0)
+
+def to_cents(series):
+    """金额列 (文本/浮点，单位元) -> int64 分"""
+    return (clean_money(series) * CENTS).round().astype("int64")
+
+def from_cents(series):
+    """int64 分 -> float64 元"""
+    return series / CENTS
+
+def _as_timestamps(series):
+    """
+    按 TIME_FORMAT 把时间列转为 datetime64；空值为 NaT。
+    只要有一个非空值不是该格式的定长文本，整列保留原文本，保证回写时原样还原
+    """
+    s = series.fillna("").astype(str).str.strip()
+    filled = s != ""
+    dt = pd.to_datetime(s.where(filled), format=TIME_FORMAT, errors="coerce")
+    if dt[filled].isna().any() or (s[filled].str.len() != 16).any():
+        return series.fillna("").astype(str)
+    return dt
+
+def _parse_date_slow(x):
+    """逐个解析的兜底：只用于快速格式解析失败的少数单元格"""
+    try:
+        dt = pd.to_datetime(x, errors='coerce')
+        if pd.isna(dt): return pd.NaT
+        return dt.replace(tzinfo=None) # 剥离时区以兼容筛选
+    except Exception:
+        return pd.NaT
+
+def parse_dates(series):
+    """
+    向量化解析时间列（仅用于看板统计，不影响原始数据显示）
+    空值一律为 NaT，绝不填充当前时间，确保无数据的单据不参与统计
+    """
+    s = series.astype(str).str.strip()
+    dt = pd.to_datetime(s, format="%Y-%m-%d %H:%M", errors='coerce')
+    rest = dt.isna() & ~s.str.lower().isin(["", "nan", "none", "nat"])
+    if rest.any():
+        dt[rest] = pd.to_datetime(s[rest].map(_parse_date_slow))
+    return dt
+
+def normalize_ledger(df):
+    """
+    统一的数据清洗入口（读取边界），每个数据版本只在缓存里执行一次：
+    金额列 -> int64 分，币种别名统一，低基数列 -> category，时间列 -> datetime64，
+    并生成隐藏辅助列 _calc_date (datetime64) 专供看板使用
+    """
+    df = df.copy()
+    for col in STANDARD_COLUMNS:
+        if col not in df.columns:
+            df[col] = 0.0 if col in MONEY_COLUMNS else ""
+    for col in MONEY_COLUMNS:
+        df[col] = to_cents(df[col])
+    df['实际币种'] = df['实际币种'].replace(CURRENCY_ALIASES)
+    for col in CATEGORY_COLUMNS:
+        df[col] = df[col].fillna("").astype(str).astype("category")
+    for col in TIME_COLUMNS:
+        df[col] = _as_timestamps(df[col])
+    if pd.api.types.is_datetime64_any_dtype(df['提交时间']):
+        df['_calc_date'] = df['提交时间']
+    else:
+        df['_calc_date'] = parse_dates(df['提交时间'])
+    return df
+
+def _format_times(series):
+    """datetime64 -> TIME_FORMAT 文本，NaT 为空串（numpy 向量化格式化，比 dt.strftime 快一个量级）"""
+    if len(series) == 0:
+        return pd.Series([], index=series.index, dtype=object)
+    values = series.to_numpy(dtype="datetime64[m]")
+    text = np.char.replace(np.datetime_as_string(values, unit="m"), "T", " ")
+    text[np.isnat(values)] = ""
+    return pd.Series(text, index=series.index, dtype=object)
+
+def to_sheet_frame(df):
+    """
+    normalize_ledger 的逆过程（写出/展示边界）：去掉辅助列，金额还原为元，
+    时间还原为表格文本，category 还原为普通文本，便于逐格修改、回写与导出
+    """
+    out = df[[c for c in STANDARD_COLUMNS if c in df.columns]].copy()
+    for col in out.columns:
+        if col in MONEY_COLUMNS and pd.api.types.is_integer_dtype(out[col]):
+            out[col] = from_cents(out[col])
+        elif col in TIME_COLUMNS and pd.api.types.is_datetime64_any_dtype(out[col]):
+            out[col] = _format_times(out[col])
+        elif isinstance(out[col].dtype, pd.CategoricalDtype):
+            out[col] = out[col].astype(object)
+    return out
+
+# --- 编号索引 ---
+def _day_serials(ids):
+    """R+日期(8位)+流水号 形式的编号拆成 (日期, 流水号) 两列，其余编号忽略"""
+    ids = ids[ids.str.fullmatch(r'R\d{9,}').fillna(False).astype(bool)]
+    return ids.str.slice(1, 9), ids.str.slice(9).astype(int)
+
+def _max_serials(ids):
+    days, serials = _day_serials(ids)
+    return serials.groupby(days).max().to_dict() if len(serials) else {}
+
+def _ledger_ids(df):
+    return df['录入编号'].astype(str) if '录入编号' in df.columns else pd.Series(dtype=str)
+
+class LedgerIndex:
     """
-    负责：生成编号、计算收支、拼装新行、重算余额
+    录入编号 -> 行位置 的哈希索引，以及 日期(YYYYMMDD) -> 当日最大流水号 表。
+    查找、定位与新编号分配都是 O(1)。建好后不再修改（其他会话可能仍在用），
+    新版本由 updated 在副本上只按改动起点之后的尾部增量生成
+    """
+
+    def __init__(self, df, revision=None):
+        ids = _ledger_ids(df)
+        self.revision = revision
+        self._ids = ids
+        # 编号重复时以第一次出现的行为准（与原先 .iloc[0] 一致）
+        values = ids.tolist()
+        self._pos = dict(zip(reversed(values), range(len(values) - 1, -1, -1)))
+        self._max_serial = _max_serials(ids)
+
+    def updated(self, start, df, revision=None):
+        """df 为新版本账本，与本版本在 start 之前的行相同：返回摘除旧尾部、登记新尾部后的新索引"""
+        ids = _ledger_ids(df)
+        new_index = LedgerIndex.__new__(LedgerIndex)
+        new_index.revision, new_index._ids = revision, ids
+        pos, max_serial = dict(self._pos), dict(self._max_serial)
+
+        removed, added = self._ids.iloc[start:], ids.iloc[start:]
+        for rec_id in removed.tolist():
+            if pos.get(rec_id, -1) >= start:
+                del pos[rec_id]
+        for offset, rec_id in enumerate(added.tolist()):
+            pos.setdefault(rec_id, start + offset)
+
+        gone, new = _max_serials(removed), _max_serials(added)
+        # 被摘除的恰是某日最大流水号时，该日最大值只能从未改动的前段重新求
+        stale = [d for d, n in gone.items() if max_serial.get(d) == n and new.get(d, 0) < n]
+        if stale:
+            days, serials = _day_serials(ids.iloc[:start])
+            prefix = serials[days.isin(stale)].groupby(days[days.isin(stale)]).max().to_dict()
+            for d in stale:
+                if d in prefix:
+                    max_serial[d] = prefix[d]
+                else:
+                    del max_serial[d]
+        for d, n in new.items():
+            max_serial[d] = max(max_serial.get(d, 0), n)
+        new_index._pos, new_index._max_serial = pos, max_serial
+        return new_index
+
+    def position(self, rec_id):
+        """编号所在的行位置，不存在返回 None"""
+        return self._pos.get(str(rec_id))
+
+    def next_serial(self, day_str):
+        """某日下一个可用的流水号"""
+        return self._max_serial.get(day_str, 0) + 1
+
+# 共享索引保留最近几个数据版本：还停在旧版本的会话照样命中，新版本从上一版派生
+INDEX_KEEP_REVISIONS = 3
+
+def _keep_recent(by_rev):
+    for rev in sorted(by_rev)[:-INDEX_KEEP_REVISIONS]:
+        del by_rev[rev]
+
+@st.cache_resource
+def _ledger_index_holder():
+    return {"lock": threading.Lock(), "by_rev": {}}
+
+def get_ledger_index(df):
+    """
+    取完整账本的编号索引，进程内按数据版本共享（与 get_option_index 相同的增量方式）；
+    临时拼出的或只含部分年份分区的 DataFrame 现建
+    """
+    rev = df.attrs.get('revision')
+    if rev is None or df.attrs.get('years') is not None:
+        return LedgerIndex(df)
+    holder = _ledger_index_holder()
+    with holder["lock"]:
+        index = holder["by_rev"].get(rev)
+        if index is not None and index.revision == rev:
+            return index
+        prev, start = holder["by_rev"].get(rev - 1), df.attrs.get('changed_from')
+        if prev is not None and start is not None:
+            index = prev.updated(start, df, revision=rev)
+        else:
+            index = LedgerIndex(df, revision=rev)
+        holder["by_rev"][rev] = index
+        _keep_recent(holder["by_rev"])
+        return index
+
+# --- 下拉选项索引 ---
+OPTION_COLUMNS = ["结算账户", "经手人", "客户/项目信息"]
+OPTION_PLACEHOLDERS = ["-- 请选择 --", "➕ 新增..."]
+
+def _option_counts(series):
+    """某列有效取值的出现次数（去空值、空白与占位项）；先计数再过滤，category 列只处理各取值一次"""
+    counts = series.value_counts()
+    counts = counts[counts > 0]
+    keys = counts.index.astype(str)
+    keep = (keys.str.strip() != "") & ~keys.isin(OPTION_PLACEHOLDERS)
+    return dict(zip(keys[keep], counts.to_numpy()[keep].tolist()))
+
+class OptionIndex:
+    """
+    下拉选项列的 取值 -> 出现次数 表，排序后的选项列表按列缓存。
+    新增/修改只需按改动行增减计数，无需整列重新去重排序；
+    与 LedgerIndex 一样建好后计数不再修改，新版本由 updated 生成
+    """
+
+    def __init__(self, df, cols=OPTION_COLUMNS, revision=None):
+        self.revision = revision
+        self._counts = {c: (_option_counts(df[c]) if c in df.columns else {}) for c in cols}
+        self._sorted = {}
+
+    def updated(self, removed, added, revision=None):
+        """按被替换的旧行 removed 与新行 added 增减计数，返回新索引（未变的列沿用本版本的计数与排序）"""
+        new_index = OptionIndex.__new__(OptionIndex)
+        new_index.revision = revision
+        new_index._counts, new_index._sorted = dict(self._counts), dict(self._sorted)
+        for col, counts in self._counts.items():
+            delta = {}
+            if col in removed.columns:
+                for v, n in _option_counts(removed[col]).items():
+                    delta[v] = delta.get(v, 0) - n
+            if col in added.columns:
+                for v, n in _option_counts(added[col]).items():
+                    delta[v] = delta.get(v, 0) + n
+            delta = {v: n for v, n in delta.items() if n}
+            if not delta:
+                continue
+            counts = dict(counts)
+            for v, n in delta.items():
+                counts[v] = counts.get(v, 0) + n
+                if counts[v] <= 0:
+                    del counts[v]
+            new_index._counts[col] = counts
+            # 只有取值集合变化才需要重新排序，这里统一作废该列的缓存
+            new_index._sorted = {k: v for k, v in new_index._sorted.items() if k[0] != col}
+        return new_index
+
+    def options(self, col, ranked=False):
+        """去重后的取值；ranked=True 按使用次数从多到少，否则按字符排序"""
+        key = (col, ranked)
+        cached = self._sorted.get(key)
+        if cached is None:
+            counts = self._counts.get(col, {})
+            if ranked:
+                cached = sorted(counts, key=lambda v: (-counts[v], v))
+            else:
+                cached = sorted(counts)
+            self._sorted[key] = cached
+        return cached
+
+@st.cache_resource
+def _option_index_holder():
+    # 版本 -> (账本, 索引)；派生下一版时要用旧账本取被替换的行
+    return {"lock": threading.Lock(), "by_rev": {}}
+
+def get_option_index(df):
+    """
+    取完整账本的下拉选项索引，进程内按数据版本共享。
+    版本只前进一步且知道改动起点 (df.attrs['changed_from']) 时，只对改动的尾部增减计数
+    """
+    rev = df.attrs.get('revision')
+    if rev is None or df.attrs.get('years') is not None:
+        # 临时拼出的或只含部分年份分区的 DataFrame 现建，不进共享索引
+        return OptionIndex(df)
+    holder = _option_index_holder()
+    with holder["lock"]:
+        _, index = holder["by_rev"].get(rev, (None, None))
+        if index is not None and index.revision == rev:
+            return index
+        prev_df, prev = holder["by_rev"].get(rev - 1, (None, None))
+        start = df.attrs.get('changed_from')
+        if prev is not None and start is not None:
+            index = prev.updated(prev_df.iloc[start:], df.iloc[start:], revision=rev)
+        else:
+            index = OptionIndex(df, revision=rev)
+        holder["by_rev"][rev] = (df, index)
+        _keep_recent(holder["by_rev"])
+        return index
+
+def build_new_rows(current_df, v, LOCAL_TZ):
+    """
+    负责：生成编号、计算收支、拼装新行，并从账本末行余额续算新行余额
     v: 传入的 entry_data 字典
+    返回只包含新行的 DataFrame（转账为两行）
     """
     now_dt = datetime.now(LOCAL_TZ)
     now_ts = now_dt.strftime("%Y-%m-%d %H:%M")
     today_str = now_dt.strftime("%Y%m%d")
 
-    # --- A. 编号生成逻辑 ---
-    today_mask = current_df['录入编号'].astype(str).str.contains(f"R{today_str}", na=False)
-    today_records = current_df[today_mask]
-    start_num = (int(str(today_records['录入编号'].iloc[-1])[-3:]) + 1) if not today_records.empty else 1
+    # --- A. 编号生成逻辑：查当日最大流水号表 ---
+    start_num = get_ledger_index(current_df).next_serial(today_str)
 
     # --- B. 内部函数：创建行模板 ---
     def create_row(offset, s, p, a, i, pr, raw_v, raw_c, inc, exp, h, n):
@@ -102,143 +389,387 @@ def prepare_new_data(current_df, v, LOCAL_TZ):
     else:
         new_rows.append(create_row(0, v['sum'], v['proj'], v['acc'], v['inv'], v['prop'], v['amt'], v['curr'], v['inc_val'], v['exp_val'], v['hand'], v['note']))
 
-    # --- D. 合并与重算余额 ---
-    new_df_rows = pd.DataFrame(new_rows, columns=current_df.columns)
-    full_df = pd.concat([current_df, new_df_rows], ignore_index=True)
+    new_df_rows = pd.DataFrame(new_rows, columns=STANDARD_COLUMNS)
+
+    # --- D. 续算余额 ---
+    return continue_balance(current_df, new_df_rows)
+
+def continue_balance(current_df, new_df_rows):
+    """
+    以账本 (normalize_ledger 之后的 current_df) 末行余额为起点，
+    为追加到末尾的新行 (单位元) 累加出 余额(USD)，按分做整数累加
+    """
+    last_bal = 0
+    if not current_df.empty and '余额(USD)' in current_df.columns:
+        last_bal = int(current_df['余额(USD)'].iloc[-1])
+    new_df_rows = new_df_rows.copy()
+    delta = to_cents(new_df_rows['收入(USD)']) - to_cents(new_df_rows['支出(USD)'])
+    new_df_rows['余额(USD)'] = from_cents(last_bal + delta.cumsum())
+    return new_df_rows
+
+def prepare_new_data(current_df, v, LOCAL_TZ):
+    """
+    负责：生成编号、计算收支、拼装新行、重算余额（整表重写模式）
+    v: 传入的 entry_data 字典
+    """
+    new_df_rows = build_new_rows(current_df, v, LOCAL_TZ)
+
+    # --- 合并与重算余额 ---
+    full_df = pd.concat([to_sheet_frame(current_df), new_df_rows], ignore_index=True)
     
-    return calculate_full_balance(full_df), [r[0] for r in new_rows]
+    # 原有行余额不变，只需从新行开始续算
+    return calculate_full_balance(full_df, start_row=len(current_df)), new_df_rows['录入编号'].tolist()
 
-def calculate_full_balance(df):
-    temp_df = df.copy()
+def calculate_full_balance(df, start_row=0):
+    """
+    重算 余额(USD)。start_row 为第一处改动所在的行位置：
+    之前的行余额原样保留，从该行起以上一行余额为起点续算，
+    修改近期记录时只需 O(尾部) 而非 O(全表)。
+    """
+    temp_df = df.reset_index(drop=True)
     
-    # 1. 强制数值列回归“纯数字”格式（float64）
-    cols_to_fix = ['实际金额', '收入(USD)', '支出(USD)', '余额(USD)']
-    for col in cols_to_fix:
+    # 1. 强制数值列回归“纯数字”格式（float64），已是数值类型的列跳过正则清洗
+    for col in MONEY_COLUMNS:
         if col in temp_df.columns:
             # 这一步非常关键：去掉逗号，转成浮点数
-            temp_df[col] = pd.to_numeric(
-                temp_df[col].astype(str).str.replace(r'[$,\s]', '', regex=True), 
-                errors='coerce'
-            ).fillna(0.0)
+            temp_df[col] = clean_money(temp_df[col])
     
-    # 2. 全量重算余额（数字运算）
-    temp_df['余额(USD)'] = temp_df['收入(USD)'].cumsum() - temp_df['支出(USD)'].cumsum()
+    # 2. 从 start_row 起续算余额（按分做整数累加，不累积浮点误差）
+    delta = to_cents(temp_df['收入(USD)']) - to_cents(temp_df['支出(USD)'])
+    start_row = min(max(int(start_row), 0), len(temp_df))
+    if start_row == 0 or '余额(USD)' not in temp_df.columns:
+        temp_df['余额(USD)'] = from_cents(delta.cumsum())
+    else:
+        seed = round(temp_df['余额(USD)'].iat[start_row - 1] * CENTS)
+        bal = temp_df['余额(USD)'].to_numpy(dtype=float, copy=True)
+        bal[start_row:] = from_cents(seed + delta.iloc[start_row:].cumsum()).to_numpy()
+        temp_df['余额(USD)'] = bal
 
     # --- ⚠️ 关键：删除所有强制转字符串的格式化代码 ---
     # 不要执行 temp_df[col].apply(lambda x: "%.2f" % x) 之类的操作！
 
     # 3. 函数锁：保持 15 列标准表头
-    standard_columns = [
-        "录入编号", "提交时间", "修改时间", "摘要", "客户/项目信息", "结算账户", 
-        "审批/发票单号", "资金性质", "实际金额", "实际币种", 
-        "收入(USD)", "支出(USD)", "余额(USD)", "经手人", "备注"
-    ]
-    temp_df = temp_df[[c for c in standard_columns if c in temp_df.columns]]
+    temp_df = temp_df[[c for c in STANDARD_COLUMNS if c in temp_df.columns]]
         
     return temp_df
-# =========================================================
-# 3. 企业微信自动化同步逻辑 (新增)
-# =========================================================
 
-def sync_wecom_to_sheets(conn):
-    """从企业微信抓取审批单并保存到 Google Sheets"""
-    # 1. 获取基础配置 (确保你在 Streamlit Secrets 已填好)
-    try:
-        CORPID = st.secrets["WECOM_CORPID"]
-        SECRET = st.secrets["WECOM_SECRET"]
-        TEMPLATE_ID = st.secrets["WECOM_TEMPLATE_ID"]
-    except Exception:
-        return "❌ 请先在 Streamlit 后台配置 Secrets (ID, Secret, TemplateID)"
+# --- 看板统计 ---
+# --- 账户头寸 ---
+POSITION_KEYS = ['结算账户', '实际币种']
+
+def signed_raw_amount(inc, exp, amt):
+    """带符号原币金额：原币金额为 0 或空时用 USD 金额代替，支出记为负数"""
+    raw = amt.where((amt != 0) & amt.notna(), inc.where(inc > 0, exp))
+    return raw.where(~(exp > 0), -raw)
+
+def account_positions(df):
+    """
+    按 (结算账户, 实际币种) 汇总 normalize_ledger 之后的账本：INC/EXP 为美元收支合计，RAW 为带符号原币合计
+    (按分精确求和后换算为元)，LAST 为该组最后一行的位置。账户余额与汇兑重估都只读这张小表；
+    本地镜像按年份分区存有同样的汇总 (LedgerMirror.account_summary)，看板不必加载全部流水
+    """
+    tmp = pd.DataFrame({
+        '结算账户': df['结算账户'], '实际币种': df['实际币种'],
+        'INC': df['收入(USD)'], 'EXP': df['支出(USD)'],
+        'RAW': signed_raw_amount(df['收入(USD)'], df['支出(USD)'], df['实际金额']),
+        'LAST': range(len(df)),
+    })
+    # 先按原始取值分组（category 列直接用编码），键的清洗只在汇总后的小表上做
+    pos = tmp.groupby(POSITION_KEYS, sort=False, observed=True, dropna=False).agg(
+        INC=('INC', 'sum'), EXP=('EXP', 'sum'), RAW=('RAW', 'sum'), LAST=('LAST', 'max')
+    ).reset_index()
+    for col in POSITION_KEYS:
+        pos[col] = pos[col].astype(object).fillna("")
+    pos[['INC', 'EXP', 'RAW']] = from_cents(pos[['INC', 'EXP', 'RAW']])
+    return merge_positions(pos)
 
-    # 2. 获取 Access Token
-    token_url = f"https://qyapi.weixin.qq.com/cgi-bin/gettoken?corpid={CORPID}&corpsecret={SECRET}"
+def merge_positions(pos):
+    """合并同一 (账户, 币种) 的多行头寸（如多个年度分区），币种别名先统一"""
+    pos = pos.assign(实际币种=pos['实际币种'].replace(CURRENCY_ALIASES))
+    return pos.groupby(POSITION_KEYS, sort=False).agg(
+        INC=('INC', 'sum'), EXP=('EXP', 'sum'), RAW=('RAW', 'sum'), LAST=('LAST', 'max')
+    ).reset_index()
+
+def account_balances(positions):
+    """
+    各账户当前余额 (原币对账)，输入为 account_positions 的头寸表：
+    USD = 收入合计 - 支出合计；RAW = 带符号原币金额合计；CUR = 该账户最后一次使用的币种
+    """
+    stats = positions.groupby('结算账户', sort=False).agg(INC=('INC', 'sum'), EXP=('EXP', 'sum'), RAW=('RAW', 'sum'))
+    used = positions[positions['实际币种'] != ""].sort_values('LAST')
+    stats['CUR'] = used.groupby('结算账户', sort=False)['实际币种'].last().reindex(stats.index).fillna("USD")
+    stats['USD'] = stats['INC'] - stats['EXP']
+    return stats.sort_index()[['USD', 'RAW', 'CUR']].reset_index()
+
+# --- 明细分页 ---
+def page_slice(df, sort_col=None, ascending=True, page=1, page_size=50):
+    """
+    明细表服务端排序 + 分页，只取出当前页的行交给前端。
+    sort_col 为空时按账本倒序（最新在前）；排序稳定，同值保持账本顺序。
+    返回 (当前页 DataFrame, 修正后的页码, 总页数)
+    """
+    n = len(df)
+    pages = max(1, -(-n // page_size))
+    page = min(max(1, int(page)), pages)
+    start, end = (page - 1) * page_size, page * page_size
+    if sort_col is None:
+        return df.iloc[::-1].iloc[start:end], page, pages
+    # 只对排序列求次序，不搬动整表
+    order = df[sort_col].reset_index(drop=True).sort_values(
+        ascending=ascending, kind="stable", na_position="last"
+    ).index[start:end]
+    return df.iloc[order], page, pages
+
+# --- 汇兑重估 ---
+def fx_revaluation(positions, rates):
+    """
+    按估值日汇率重估各账户的原币头寸（输入为 account_positions 的头寸表）：
+    原币余额按 (结算账户, 币种) 汇总，重估(USD) = 原币余额 / 汇率，
+    账面(USD) = 入账时折算的 收入 - 支出，未实现汇兑损益 = 重估 - 账面。
+    rates 为 1 USD 兑各币种（见 get_rates_on）；汇率缺失的币种按账面值，不计损益。
+    """
+    cur = positions['实际币种'].astype(str).str.strip().str.upper()
+    tmp = pd.DataFrame({
+        '结算账户': positions['结算账户'],
+        '币种': cur.where(cur != "", "USD").replace(ISO_MAP),
+        '原币余额': positions['RAW'],
+        '账面(USD)': positions['INC'] - positions['EXP'],
+    })
+    pos = tmp.groupby(['结算账户', '币种'], sort=True).sum().reset_index()
+    rate = pos['币种'].map(rates).astype(float)
+    pos['汇率'] = rate
+    pos['重估(USD)'] = (pos['原币余额'] / rate).round(2).fillna(pos['账面(USD)'])
+    pos['汇兑损益(USD)'] = (pos['重估(USD)'] - pos['账面(USD)']).round(2) + 0.0  # 去掉 -0.00
+    return pos[['结算账户', '币种', '原币余额', '汇率', '账面(USD)', '重估(USD)', '汇兑损益(USD)']]
+
+# --- 时间维度聚合表 ---
+CUBE_KEYS = ['年', '月', '资金性质', '结算账户']
+CUBE_VALUES = ['收入(USD)', '支出(USD)', '笔数']
+
+def period_cube_source(df):
+    """聚合表的输入列（与 df 行一一对应），无日期的单据 年/月 为空"""
+    d = df['_calc_date']
+    return pd.DataFrame({
+        '年': d.dt.year, '月': d.dt.month,
+        '资金性质': df['资金性质'].astype(object).fillna(""),
+        '结算账户': df['结算账户'].astype(object).fillna(""),
+        '收入(USD)': df['收入(USD)'], '支出(USD)': df['支出(USD)'], '笔数': 1,
+    }, index=df.index)
+
+def build_period_cube(src):
+    """按 (年, 月, 资金性质, 结算账户) 预聚合收入/支出/笔数，无日期的单据不参与"""
+    src = src.dropna(subset=['年', '月'])
+    if src.empty:
+        idx = pd.MultiIndex.from_arrays([[], [], [], []], names=CUBE_KEYS)
+        return pd.DataFrame({c: pd.Series(dtype=float) for c in CUBE_VALUES}, index=idx)
+    src = src.astype({'年': int, '月': int})
+    return src.groupby(CUBE_KEYS, sort=True)[CUBE_VALUES].sum()
+
+def update_period_cube(cube, removed=None, added=None):
+    """增量维护聚合表：减去删除/修改前的行，加上新增/修改后的行 (参数均为 period_cube_source 的切片)"""
+    for rows, sign in ((removed, -1), (added, 1)):
+        if rows is not None and not rows.empty:
+            cube = cube.add(build_period_cube(rows) * sign, fill_value=0)
+    return cube[cube['笔数'] != 0]
+
+def cube_month(cube, year, month):
+    """查表得出某月 收入合计、支出合计 与 支出排行 (按资金性质)；聚合表按分累计，这里换算为元"""
     try:
-        token_res = requests.get(token_url).json()
-        token = token_res.get("access_token")
-        if not token:
-            return f"❌ Token获取失败: {token_res.get('errmsg')}"
-    except Exception as e:
-        return f"🌐 网络连接异常: {e}"
-
-    # 3. 获取最近 7 天已通过的审批单 (sp_status=2)
-    list_url = f"https://qyapi.weixin.qq.com/cgi-bin/oa/getapprovalinfo?access_token={token}"
-    import time
-    now = int(time.time())
-    payload = {
-        "starttime": str(now - 604800), 
-        "endtime": str(now),
-        "cursor": 0,
-        "size": 100,
-        "filters": [
-            {"key": "template_id", "value": TEMPLATE_ID},
-            {"key": "sp_status", "value": "2"}
-        ]
-    }
-    
-    res_list = requests.post(list_url, json=payload).json()
-    sp_nos = res_list.get("sp_no_list", [])
-    
-    if not sp_nos:
-        return "📭 最近 7 天没有发现新通过的审批单。"
+        part = cube.xs((int(year), int(month)), level=['年', '月'])
+    except KeyError:
+        return 0.0, 0.0, pd.DataFrame(columns=['资金性质', '支出(USD)'])
+    ranking = from_cents(part.groupby(level='资金性质')[['支出(USD)']].sum())
+    ranking = ranking[ranking['支出(USD)'] > 0].sort_values(by='支出(USD)', ascending=False).reset_index()
+    return part['收入(USD)'].sum() / CENTS, part['支出(USD)'].sum() / CENTS, ranking
 
-    # 4. 读取现有数据用于去重
-    df_existing = conn.read(worksheet="Transactions")
-    existing_ids = df_existing['录入编号'].astype(str).tolist() if '录入编号' in df_existing.columns else []
+# --- 追加写入 (只上传新行) ---
+def append_ledger_rows(store, current_df, new_df_rows):
+    """
+    把已续算好余额的新行追加到存储末尾（只上传这几行）。
+    存储末尾与 current_df 不一致或后端不支持追加时不写入，返回 False
+    """
+    if '录入编号' not in current_df.columns:
+        return False
+    last_id = current_df['录入编号'].iloc[-1] if len(current_df) else None
+    rows = new_df_rows.reindex(columns=STANDARD_COLUMNS)
+    with perf.span("store.append") as sp:
+        ok = store.append(rows, expect_rows=len(current_df), expect_last_id=last_id)
+        sp.set(appended=ok)
+    if perf.is_enabled():
+        sp.measure(rows)
+    return ok
 
-    new_rows = []
-    detail_url = f"https://qyapi.weixin.qq.com/cgi-bin/oa/getapprovaldetail?access_token={token}"
-    
-    # 获取实时汇率用于转换
-    rates = get_live_rates()
-
-    for sp_no in sp_nos:
-        unique_id = f"WE-{sp_no[-8:]}" # 生成企微专属编号
-        if unique_id in existing_ids:
-            continue
-            
-        det = requests.post(detail_url, json={"sp_no": sp_no}).json()
-        info = det.get("info", {})
-        contents = info.get("apply_data", {}).get("contents", [])
-
-        try:
-            # 🌟 核心映射逻辑 (请根据你企微表单的顺序调整索引数字)
-            raw_amt = float(contents[1]['value']['new_number']) # 假设第二个框是金额
-            curr = "USD" # 假设默认是USD，如果是多币种需解析 contents
-            
-            # 计算美元价值
-            inc_usd = 0.0
-            exp_usd = raw_amt / rates.get(curr, 1.0) # 假设全是支出
-            
-            row_data = {
-                "录入编号": unique_id,
-                "提交时间": datetime.fromtimestamp(info.get("apply_time")).strftime('%Y-%m-%d %H:%M'),
-                "修改时间": "",
-                "摘要": contents[0]['value']['text'], # 假设第一个框是摘要
-                "客户/项目信息": "企微同步",
-                "结算账户": "待分类",
-                "审批/发票单号": sp_no,
-                "资金性质": "企微导入",
-                "实际金额": raw_amt,
-                "实际币种": curr,
-                "收入(USD)": inc_usd,
-                "支出(USD)": exp_usd,
-                "余额(USD)": 0, # 后面会重算
-                "经手人": info.get("applyer", {}).get("name"),
-                "备注": "来自企业微信自动化同步"
-            }
-            new_rows.append(row_data)
-        except Exception:
-            continue
-
-    # 5. 合并、重算并更新
-    if new_rows:
-        df_new = pd.DataFrame(new_rows)
-        # 合并后使用你现有的 calculate_full_balance 函数重新计算所有余额
-        full_df = pd.concat([df_existing, df_new], ignore_index=True)
-        final_df = calculate_full_balance(full_df)
-        
-        conn.update(worksheet="Transactions", data=final_df)
-        return f"✅ 成功从企微同步 {len(new_rows)} 条数据！"
-    
-    return "😴 所有单据已在账目中，无需更新。"
-    
+def commit_rows(store, current_df, make_rows, on_written=None):
+    """
+    新行的统一写入入口，current_df 为 normalize_ledger 之后的账本，
+    make_rows(ledger_df) 负责基于给定账本生成编号并续算余额：
+    - 存储末尾与加载时一致：只追加新行，余额在本地续算
+    - 已被他人修改或后端不支持追加：以存储里的最新数据重新生成，再整表重算重写
+    写入成功后调用 on_written(起始行, 该行起的全部新内容)，供镜像直接应用同一改动。
+    返回 (写入模式 "append"/"rewrite", 新编号列表)
+    """
+    new_df_rows = make_rows(current_df)
+    if append_ledger_rows(store, current_df, new_df_rows):
+        if on_written is not None:
+            on_written(len(current_df), new_df_rows)
+        return "append", new_df_rows['录入编号'].tolist()
+
+    # 回退：以最新数据为准重新生成编号与余额；已有行按读到的原样写回
+    with perf.span("store.read") as sp:
+        raw_df = store.read()
+    if perf.is_enabled():
+        sp.measure(raw_df)
+    new_df_rows = make_rows(normalize_ledger(raw_df))
+    full_df = pd.concat([raw_df, new_df_rows], ignore_index=True)
+    full_df = calculate_full_balance(full_df, start_row=len(raw_df))
+    with perf.span("store.replace_all") as sp:
+        store.replace_all(full_df)
+    if perf.is_enabled():
+        sp.measure(full_df)
+    if on_written is not None:
+        on_written(0, full_df)
+    return "rewrite", new_df_rows['录入编号'].tolist()
+
+def ledger_keys(df):
+    """每行的 (录入编号, 修改时间) 表格文本，与 LedgerStore.read_keys 的格式一致"""
+    keys = to_sheet_frame(df.reindex(columns=['录入编号', '修改时间']))
+    return list(zip(keys['录入编号'].fillna("").astype(str), keys['修改时间'].fillna("").astype(str)))
+
+def commit_row_change(store, current_df, rec_id, change, on_written=None):
+    """
+    按编号修改或删除一行的统一写入入口，current_df 为 normalize_ledger 之后的账本。
+    change(sheet_df, idx) 接收表格格式的账本片段与目标行位置，返回改好的片段（删除即去掉该行）；
+    余额从目标行起续算：
+    - 存储里从上一行到末尾的 编号+修改时间 与 current_df 一致：只删除/回写目标行及其后的尾部
+    - 不一致（本地镜像落后或表格被手工改过）：以存储里的最新数据重新定位，再整表重算重写
+    写入成功后调用 on_written(起始行, 该行起的全部新内容)。
+    返回写入模式 "update"/"rewrite"；编号在存储里已不存在时不写入，返回 None
+    """
+    pos = get_ledger_index(current_df).position(rec_id)
+    if pos is not None:
+        base = max(pos - 1, 0)
+        with perf.span("store.keys_match") as sp:
+            matched = store.keys_match(base, ledger_keys(current_df.iloc[base:]))
+            sp.set(matched=matched)
+        if matched:
+            tail = to_sheet_frame(current_df.iloc[base:]).reset_index(drop=True)
+            idx = pos - base
+            tail = calculate_full_balance(change(tail, idx), start_row=idx)
+            removed = len(current_df) - base - len(tail)
+            if removed > 0:
+                with perf.span("store.delete_rows", rows=removed):
+                    store.delete_rows(pos, pos + removed)
+            with perf.span("store.update_rows") as sp:
+                store.update_rows(pos, tail.iloc[idx:])
+            if perf.is_enabled():
+                sp.measure(tail.iloc[idx:])
+            if on_written is not None:
+                on_written(pos, tail.iloc[idx:])
+            return "update"
+
+    # 回退：按存储里的最新数据重新定位；其余行按读到的原样写回（转 object 以便逐格写入数值）
+    with perf.span("store.read") as sp:
+        raw_df = store.read().reset_index(drop=True).astype(object)
+    if perf.is_enabled():
+        sp.measure(raw_df)
+    pos = get_ledger_index(raw_df).position(rec_id)
+    if pos is None:
+        return None
+    full_df = calculate_full_balance(change(raw_df, pos), start_row=pos)
+    with perf.span("store.replace_all") as sp:
+        store.replace_all(full_df)
+    if perf.is_enabled():
+        sp.measure(full_df)
+    if on_written is not None:
+        on_written(0, full_df)
+    return "rewrite"
+
+def commit_new_entry(store, current_df, v, LOCAL_TZ, on_written=None):
+    """新增单笔流水（转账两行），写入策略见 commit_rows"""
+    return commit_rows(store, current_df, lambda df: build_new_rows(df, v, LOCAL_TZ), on_written)
+
+# --- 批量导入 ---
+# 导入模板列（与 entry_dialog 的输入项一一对应）
+BULK_COLUMNS = ["摘要", "原币金额", "原币币种", "汇率", "审批/发票单号", "资金性质",
+                "结算账户", "转出账户", "转入账户", "经手人", "客户/项目信息", "备注"]
+_BULK_TEXT = [c for c in BULK_COLUMNS if c not in ("原币金额", "汇率")]
+_PLACEHOLDERS = ["", "-- 请选择 --", "➕ 新增...", "nan", "None"]
+
+def validate_bulk_entries(raw_df):
+    """
+    一次向量化校验全部导入行，规则与 entry_dialog 一致。
+    返回 (规范化后的 DataFrame, 每行错误信息 Series，空串表示通过)
+    """
+    df = raw_df.reindex(columns=BULK_COLUMNS).reset_index(drop=True)
+    for col in _BULK_TEXT:
+        df[col] = df[col].fillna("").astype(str).str.strip()
+        df.loc[df[col].isin(_PLACEHOLDERS), col] = ""
+    df['原币金额'] = pd.to_numeric(df['原币金额'].astype(str).str.replace(r'[$,\s]', '', regex=True), errors='coerce')
+    df['汇率'] = pd.to_numeric(df['汇率'], errors='coerce')
+    # 币种：中文名/小写统一为 ISO 代码，留空按 USD
+    curr = df['原币币种'].str.upper().replace("", "USD")
+    df['原币币种'] = curr.replace(ISO_MAP)
+
+    errors = pd.Series("", index=df.index)
+    def flag(mask, msg):
+        nonlocal errors
+        errors = errors.mask(mask, errors + msg + "；")
+
+    is_transfer = df['资金性质'] == "资金结转"
+    flag(df['摘要'] == "", "摘要为空")
+    flag(~(df['原币金额'] > 0), "原币金额必须大于 0")
+    flag(df['审批/发票单号'] == "", "缺少审批/发票单号")
+    flag(~df['资金性质'].isin(ALL_PROPS), "资金性质无效")
+    flag(~df['原币币种'].isin(ALL_CURRENCIES), "币种不支持")
+    flag(df['汇率'].notna() & ~(df['汇率'] > 0), "汇率必须大于 0")
+    flag(~is_transfer & (df['结算账户'] == ""), "缺少结算账户")
+    flag(~is_transfer & (df['经手人'] == ""), "缺少经手人")
+    flag(is_transfer & ((df['转出账户'] == "") | (df['转入账户'] == "")), "转出和转入账户均不能为空")
+    flag(is_transfer & (df['转出账户'] != "") & (df['转出账户'] == df['转入账户']), "转出账户和转入账户不能相同")
+    flag(df['资金性质'].isin(CORE_BIZ) & (df['客户/项目信息'] == ""), "该资金性质必须关联有效项目")
+    return df, errors.str.rstrip("；")
+
+def build_bulk_rows(current_df, entries, rates, LOCAL_TZ):
+    """
+    把校验通过的导入行换算为账本行：未填汇率的按实时汇率折美元，
+    资金结转拆成转出/转入两行，编号整块连续分配，并从账本末行续算余额
+    """
+    now_dt = datetime.now(LOCAL_TZ)
+    today_str = now_dt.strftime("%Y%m%d")
+    e = entries.reset_index(drop=True)
+
+    rate = e['汇率'].where(e['汇率'] > 0, e['原币币种'].map(rates).astype(float).fillna(1.0))
+    usd = (e['原币金额'] / rate).round(2)
+    is_transfer = e['资金性质'] == "资金结转"
+    is_inc = e['资金性质'].isin(CORE_BIZ[:5] + INC_OTHER)
+    is_exp = e['资金性质'].isin(CORE_BIZ[5:] + EXP_OTHER)
+
+    base = pd.DataFrame({
+        "摘要": e['摘要'], "客户/项目信息": e['客户/项目信息'], "结算账户": e['结算账户'],
+        "审批/发票单号": e['审批/发票单号'], "资金性质": e['资金性质'],
+        "实际金额": e['原币金额'].round(2), "实际币种": e['原币币种'],
+        "收入(USD)": usd.where(is_inc, 0.0), "支出(USD)": usd.where(is_exp, 0.0),
+        "经手人": e['经手人'], "备注": e['备注'], "_order": e.index * 2,
+    })
+    # 资金结转：双分录，与单笔录入保持一致
+    tr = base[is_transfer]
+    t_usd = usd[is_transfer]
+    out_rows = tr.assign(**{"摘要": "【转出】" + tr['摘要'], "客户/项目信息": "内部调拨", "结算账户": e.loc[is_transfer, '转出账户'],
+                           "收入(USD)": 0.0, "支出(USD)": t_usd, "经手人": "系统自动结转"})
+    in_rows = tr.assign(**{"摘要": "【转入】" + tr['摘要'], "客户/项目信息": "内部調拨", "结算账户": e.loc[is_transfer, '转入账户'],
+                          "收入(USD)": t_usd, "支出(USD)": 0.0, "经手人": "系统自动结转", "_order": tr['_order'] + 1})
+    rows = pd.concat([base[~is_transfer], out_rows, in_rows]).sort_values('_order', kind='stable')
+
+    # 整块分配编号
+    start_num = get_ledger_index(current_df).next_serial(today_str)
+    serials = pd.Series(range(start_num, start_num + len(rows)), index=rows.index).astype(str).str.zfill(3)
+    rows["录入编号"] = "R" + today_str + serials
+    rows["提交时间"] = now_dt.strftime("%Y-%m-%d %H:%M")
+    rows["修改时间"] = ""
+    rows["余额(USD)"] = 0.0
+    rows = rows[STANDARD_COLUMNS].reset_index(drop=True)
+    return continue_balance(current_df, rows)
+
+def commit_bulk_entries(store, current_df, entries, rates, LOCAL_TZ, on_written=None):
+    """批量导入：一次写入 + 一次余额续算，写入策略见 commit_rows"""
+    return commit_rows(store, current_df, lambda df: build_bulk_rows(df, entries, rates, LOCAL_TZ), on_written)
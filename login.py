@@ -170,6 +170,7 @@ def show_login_page():
                 st.markdown(f'<div class="custom-error-box">{L["err_empty"]}</div>', unsafe_allow_html=True)
             elif u == "123" and p == "123":
                 st.session_state.logged_in = True
+                st.session_state.username = u  # 登录框的 key 在登录后不再渲染会被清掉，单独保存账号
                 st.rerun()
             else:
                 st.markdown(f'<div class="custom-error-box">{L["err_wrong"]}</div>', unsafe_allow_html=True)
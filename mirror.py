@@ -0,0 +1,325 @@
+import os
+import sqlite3
+import threading
+import time
+import pandas as pd
+import streamlit as st
+import perf
+from logic import STANDARD_COLUMNS, MONEY_COLUMNS, clean_money, parse_dates, normalize_ledger, merge_positions
+
+# =========================================================
+# 本地账本镜像 (SQLite)：看板只读本地，账本存储只做增量同步
+# =========================================================
+
+MIRROR_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".ledger_mirror.sqlite")
+FULL_RESYNC_SECONDS = 24 * 3600  # 每天至少做一次全量校准，兜底云端手工改动
+SCHEMA_VERSION = 2  # 表结构变化时本地镜像整体重建（数据以账本存储为准）
+UNDATED = 0         # 提交时间无法解析的行归入 0 号分区，不出现在按年看板中
+RETRY_SECONDS = 15          # 同步失败后的首次重试间隔，之后逐次加倍
+RETRY_MAX_SECONDS = 300     # 重试间隔上限
+
+def _q(col):
+    """SQLite 列名加引号（表头含中文、括号和斜杠）"""
+    return '"' + col.replace('"', '""') + '"'
+
+def _year_filter(years):
+    """years 为 None 时不过滤，否则返回 (WHERE 子句, 参数)"""
+    if years is None:
+        return "", []
+    years = sorted({int(y) for y in years})
+    return f"WHERE year IN ({', '.join('?' * len(years))})", years
+
+class LedgerMirror:
+    """
+    账本存储（默认 Summary 工作表）的本地镜像，以 录入编号 为键、pos 保持原表行序。
+    增量同步只下载 编号 + 修改时间 两列，找到第一处不一致的行，
+    再只拉取该行之后的尾部（余额是累计值，改动行之后的余额都会变）。
+
+    每行按提交时间的年份归入分区 (year 列)，并维护两张分区汇总表：
+    partitions 记录每年的笔数、收支与结转的年初/年末结余，
+    account_summary 记录每年按 (结算账户, 实际币种) 汇总的头寸。
+    看板只加载所选年份的明细，累计数字都从汇总表得出。
+    """
+
+    def __init__(self, path=MIRROR_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._sync_thread = None
+        self.last_error = None
+        self.last_sync_ts = 0.0
+        self.last_sync_stats = None  # 最近一次同步：{"rows", "ms", "full", "read_ms": 读取存储耗时, "bytes": 下载字节数}
+        self.dirty = False           # 有写入未能直接应用到镜像，下次访问需立即同步
+        self.retry_at = 0.0          # 同步失败后的退避：此时间之前不再访问云端
+        self._failures = 0
+        with self._db() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            if int(self._meta(db, "schema", 1)) != SCHEMA_VERSION:
+                # 旧版镜像没有分区列：清空后由下一次同步全量重建（版本号保留，继续递增）
+                for table in ("ledger", "partitions", "account_summary"):
+                    db.execute(f"DROP TABLE IF EXISTS {table}")
+                db.execute("DELETE FROM meta WHERE key = 'last_full_sync'")
+                db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('schema', ?)", (str(SCHEMA_VERSION),))
+            cols = ", ".join(f"{_q(c)} {'REAL' if c in MONEY_COLUMNS else 'TEXT'}" for c in STANDARD_COLUMNS)
+            db.execute(f"CREATE TABLE IF NOT EXISTS ledger (pos INTEGER PRIMARY KEY, year INTEGER, {cols})")
+            db.execute(f"CREATE INDEX IF NOT EXISTS idx_ledger_id ON ledger ({_q('录入编号')})")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_ledger_year ON ledger (year, pos)")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS partitions (year INTEGER PRIMARY KEY, rows INTEGER, "
+                "income REAL, expense REAL, opening REAL, closing REAL)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS account_summary (year INTEGER, account TEXT, currency TEXT, "
+                "inc REAL, exp REAL, raw REAL, last_pos INTEGER, PRIMARY KEY (year, account, currency))"
+            )
+
+    def _db(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def _meta(self, db, key, default=None):
+        row = db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    @property
+    def revision(self):
+        """镜像数据版本号，每次内容变化 +1，用作读缓存的键"""
+        with self._db() as db:
+            return int(self._meta(db, "revision", 0))
+
+    def changed_from(self, revision):
+        """revision 相对上一版本第一处改动的行位置；版本已被覆盖则返回 None"""
+        with self._db() as db:
+            if int(self._meta(db, "revision", 0)) != revision:
+                return None
+            return int(self._meta(db, "changed_from", 0))
+
+    # --- 读 ---
+    def read(self, years=None):
+        """
+        按原表行序读出账本（金额列已是 float64）；years 给出时只读这些年份的分区。
+        df.attrs['revision'] 为对应的镜像版本，df.attrs['changed_from'] 为相对上一版本第一处改动在本结果中的行位置，
+        df.attrs['years'] 为读取的分区（完整账本为 None）
+        """
+        where, args = _year_filter(years)
+        with self._db() as db:
+            db.execute("BEGIN")  # 数据与版本号在同一快照内读取
+            df = pd.read_sql_query(
+                f"SELECT {', '.join(_q(c) for c in STANDARD_COLUMNS)} FROM ledger {where} ORDER BY pos", db, params=args
+            )
+            changed = int(self._meta(db, "changed_from", 0))
+            if years is not None:
+                # 改动起点之前的行两个版本相同，它们在分区结果里的行数即为本结果中的改动起点
+                changed = db.execute(f"SELECT COUNT(*) FROM ledger {where} AND pos < ?", [*args, changed]).fetchone()[0]
+            df.attrs['revision'] = int(self._meta(db, "revision", 0))
+            df.attrs['changed_from'] = changed
+            df.attrs['years'] = tuple(args) if years is not None else None
+        return df
+
+    def partitions(self):
+        """
+        各年度分区汇总 (按年份升序)：笔数、收入、支出，以及逐年结转的 年初结余 / 年末结余。
+        无日期的行归在 UNDATED 分区，排在最前
+        """
+        with self._db() as db:
+            return pd.read_sql_query(
+                "SELECT year AS 年, rows AS 笔数, income AS '收入(USD)', expense AS '支出(USD)', "
+                "opening AS 年初结余, closing AS 年末结余 FROM partitions ORDER BY year", db
+            )
+
+    def account_summary(self, years=None):
+        """各分区按 (结算账户, 实际币种) 汇总的头寸，列与 logic.account_positions 一致，经 merge_positions 合并后使用"""
+        where, args = _year_filter(years)
+        with self._db() as db:
+            return pd.read_sql_query(
+                "SELECT account AS 结算账户, currency AS 实际币种, inc AS INC, exp AS EXP, raw AS RAW, last_pos AS LAST "
+                f"FROM account_summary {where}", db, params=args
+            )
+
+    def _keys(self, db):
+        return db.execute(f"SELECT {_q('录入编号')}, {_q('修改时间')} FROM ledger ORDER BY pos").fetchall()
+
+    # --- 写 ---
+    def _replace_tail(self, db, start, rows):
+        """用 rows (二维列表，按 STANDARD_COLUMNS 排列) 替换 pos >= start 的所有行"""
+        # 被替换的尾部和新行涉及的年份都要重算汇总
+        touched = {y for (y,) in db.execute("SELECT DISTINCT year FROM ledger WHERE pos >= ?", (start,))}
+        db.execute("DELETE FROM ledger WHERE pos >= ?", (start,))
+        if rows:
+            df = pd.DataFrame(rows, columns=STANDARD_COLUMNS)
+            for col in MONEY_COLUMNS:
+                df[col] = clean_money(df[col])
+            # 分区年份与看板的 _calc_date 使用同一套解析
+            years = parse_dates(df['提交时间']).dt.year.fillna(UNDATED).astype(int)
+            touched |= set(years)
+            df.insert(0, "year", years)
+            df.insert(0, "pos", range(start, start + len(df)))
+            placeholders = ", ".join("?" * len(df.columns))
+            db.executemany(
+                f"INSERT INTO ledger (pos, year, {', '.join(_q(c) for c in STANDARD_COLUMNS)}) VALUES ({placeholders})",
+                df.astype(object).where(df.notna(), None).itertuples(index=False, name=None),
+            )
+        self._summarize(db, touched)
+        rev = int(self._meta(db, "revision", 0)) + 1
+        db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('revision', ?)", (str(rev),))
+        # 记录本次改动起始行，供下游聚合做增量更新
+        db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('changed_from', ?)", (str(start),))
+
+    def _summarize(self, db, years):
+        """重算指定年份的分区汇总与账户头寸，再把年初/年末结余逐年结转一遍"""
+        years = sorted(int(y) for y in years)
+        if years:
+            marks = ", ".join("?" * len(years))
+            inc, exp, amt = _q('收入(USD)'), _q('支出(USD)'), _q('实际金额')
+            raw = f"(CASE WHEN COALESCE({amt}, 0) != 0 THEN {amt} WHEN {inc} > 0 THEN {inc} ELSE {exp} END)"
+            db.execute(f"DELETE FROM partitions WHERE year IN ({marks})", years)
+            db.execute(f"DELETE FROM account_summary WHERE year IN ({marks})", years)
+            db.execute(
+                f"INSERT INTO partitions (year, rows, income, expense) "
+                f"SELECT year, COUNT(*), SUM({inc}), SUM({exp}) FROM ledger WHERE year IN ({marks}) GROUP BY year",
+                years,
+            )
+            db.execute(
+                f"INSERT INTO account_summary (year, account, currency, inc, exp, raw, last_pos) "
+                f"SELECT year, COALESCE({_q('结算账户')}, ''), COALESCE({_q('实际币种')}, ''), SUM({inc}), SUM({exp}), "
+                f"SUM(CASE WHEN {exp} > 0 THEN -{raw} ELSE {raw} END), MAX(pos) "
+                f"FROM ledger WHERE year IN ({marks}) GROUP BY 1, 2, 3",
+                years,
+            )
+        balance = 0.0
+        for y, income, expense in db.execute("SELECT year, income, expense FROM partitions ORDER BY year").fetchall():
+            closing = balance + (income or 0.0) - (expense or 0.0)
+            db.execute("UPDATE partitions SET opening = ?, closing = ? WHERE year = ?", (balance, closing, y))
+            balance = closing
+
+    # --- 同步 ---
+    def sync(self, store, full=False):
+        """
+        与账本存储同步，返回本次下载的数据行数。
+        full=True 或镜像为空/超过一天未全量校准时做全量同步。
+        """
+        with self._lock:
+            t0 = time.perf_counter()
+            self.dirty = False  # 在读取云端之前清除，同步期间的写入会重新置位
+            with self._db() as db:
+                last_full = float(self._meta(db, "last_full_sync", 0))
+                full = full or not self._keys(db) or (time.time() - last_full > FULL_RESYNC_SECONDS)
+
+            net = {"read_ms": 0.0, "bytes": 0}
+            if full:
+                fetched = self._apply(0, self._rows(self._fetch(net, store.read)), full=True)
+            else:
+                fetched = self._delta(store, net)
+
+            self.last_sync_ts = time.time()
+            self.last_sync_stats = {
+                "rows": fetched, "ms": round((time.perf_counter() - t0) * 1000, 3), "full": bool(full),
+                "read_ms": round(net["read_ms"], 3), "bytes": net["bytes"],
+            }
+            self.last_error = None
+            return fetched
+
+    def _rows(self, df):
+        return df.reindex(columns=STANDARD_COLUMNS).astype(object).where(df.notna(), "").values.tolist()
+
+    def _apply(self, start, rows, full=False):
+        with self._db() as db:
+            self._replace_tail(db, start, rows)
+            if full:
+                db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_full_sync', ?)", (str(time.time()),))
+        return len(rows)
+
+    def _fetch(self, net, read, *args):
+        """调用一次存储读取，把耗时与字节数累计到 net（同步在后台线程里，perf.span 不生效）"""
+        t0 = time.perf_counter()
+        data = read(*args)
+        net["read_ms"] += (time.perf_counter() - t0) * 1000
+        net["bytes"] += perf.nbytes(data)
+        return data
+
+    def _delta(self, store, net):
+        remote = self._fetch(net, store.read_keys)
+        with self._db() as db:
+            local = [(str(a or ""), str(b or "")) for a, b in self._keys(db)]
+
+        # 第一处不一致的行位置
+        start = next((i for i, (r, l) in enumerate(zip(remote, local)) if r != l), min(len(remote), len(local)))
+        if start == len(remote) == len(local):
+            return 0
+
+        rows = self._rows(self._fetch(net, store.read, start, len(remote))) if start < len(remote) else []
+        return self._apply(start, rows)
+
+    def write_through(self, start, rows_df, base_revision=None):
+        """
+        写入账本存储成功后，把同一段尾部（pos >= start 的全部新内容）直接应用到镜像并推进版本号，
+        其他会话按新版本号读取即可，不必再访问云端。
+        start > 0 时要求镜像仍是写入所依据的版本 base_revision；版本不符或正在同步时
+        只标记 dirty，由下一次增量同步补齐。返回是否已应用
+        """
+        if not self._lock.acquire(blocking=False):
+            self.dirty = True
+            return False
+        try:
+            with self._db() as db:
+                db.execute("BEGIN IMMEDIATE")
+                if start > 0 and (base_revision is None or int(self._meta(db, "revision", 0)) != base_revision):
+                    self.dirty = True
+                    return False
+                self._replace_tail(db, start, self._rows(rows_df))
+            return True
+        finally:
+            self._lock.release()
+
+    @property
+    def syncing(self):
+        return self._sync_thread is not None and self._sync_thread.is_alive()
+
+    def due(self, interval):
+        """是否该访问云端：超过同步间隔或有未应用的写入，且不在失败退避期内"""
+        if time.time() < self.retry_at:
+            return False
+        return self.dirty or time.time() - self.last_sync_ts > interval
+
+    def sync_async(self, store, wait=2.0, full=False, log=False):
+        """
+        后台线程同步，最多等待 wait 秒（None 为等到完成，0 为不等待）；超时则先用本地镜像，同步在后台继续。
+        已有同步在进行时不再新开线程。失败后按退避间隔推迟下一次尝试 (见 due)。
+        log=True 时同步结束后把 last_sync_stats 写入计时日志。
+        返回同步是否已在等待时间内完成。
+        """
+        if not self.syncing:
+            def _run():
+                try:
+                    self.sync(store, full=full)
+                    self._failures, self.retry_at = 0, 0.0
+                    if log:
+                        perf.log_span("mirror.sync", **self.last_sync_stats)
+                except Exception as e:
+                    if log:
+                        perf.log_span("mirror.sync", error=type(e).__name__)
+                    self.last_error = e
+                    self._failures += 1
+                    self.retry_at = time.time() + min(RETRY_SECONDS * 2 ** (self._failures - 1), RETRY_MAX_SECONDS)
+                    print(f"⚠️ 本地镜像同步失败，继续使用本地数据: {e}")
+            self._sync_thread = threading.Thread(target=_run, daemon=True)
+            self._sync_thread.start()
+        self._sync_thread.join(timeout=wait)
+        return not self._sync_thread.is_alive()
+
+@st.cache_resource
+def get_mirror(path=MIRROR_PATH):
+    """进程内共享同一个镜像对象（所有会话共用一个 SQLite 文件）"""
+    return LedgerMirror(path)
+
+def publish_write(base_df, start, rows_df):
+    """写入方调用：base_df 为写入所依据的账本（取其 attrs['revision']），rows_df 为从 start 起写入后的全部尾部"""
+    return get_mirror().write_through(start, rows_df, base_df.attrs.get('revision'))
+
+@st.cache_data(max_entries=8)
+def read_ledger(revision, years=None):
+    """以 (镜像版本号, 年份分区) 作为缓存键：读取、清洗、类型转换每个数据版本只做一次"""
+    return normalize_ledger(get_mirror().read(years))
+
+@st.cache_data(max_entries=4)
+def read_summaries(revision):
+    """分区汇总与账户头寸：累计结余、各账户余额与汇兑重估都从这里得出，不加载历史明细"""
+    return get_mirror().partitions(), merge_positions(get_mirror().account_summary())
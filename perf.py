@@ -0,0 +1,142 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+# =========================================================
+# 热路径计时：每次重跑按阶段记录耗时、行数、字节数
+# =========================================================
+# 未开启时 span() 只做一次线程局部变量判断并返回共享的空对象，开销可忽略；
+# 开启后每次重跑的记录保存在会话里供侧边栏展示，并以 JSON Lines 追加到本地日志。
+
+PERF_LOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".perf_log.jsonl")
+
+_local = threading.local()
+_log_lock = threading.Lock()
+
+class _NoopSpan:
+    """未开启计时时的占位对象，所有调用都是空操作"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **fields):
+        pass
+
+    def measure(self, data):
+        pass
+
+_NOOP = _NoopSpan()
+
+def nbytes(data):
+    """DataFrame/二维列表/字节串的大致字节数（只在开启计时时调用）"""
+    if data is None:
+        return 0
+    if hasattr(data, "memory_usage"):
+        return int(data.memory_usage(index=False, deep=True).sum())
+    if isinstance(data, (bytes, bytearray)):
+        return len(data)
+    if isinstance(data, list):
+        return sum(len(str(c).encode("utf-8")) for row in data for c in (row if isinstance(row, (list, tuple)) else [row]))
+    return len(str(data).encode("utf-8"))
+
+class _Span:
+    __slots__ = ("record", "_t0", "_sink")
+
+    def __init__(self, name, sink, fields):
+        self.record = {"name": name, **fields}
+        self._sink = sink
+
+    def __enter__(self):
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.record["ms"] = round((time.perf_counter() - self._t0) * 1000, 3)
+        if exc_type is not None:
+            self.record["error"] = exc_type.__name__
+        self._sink(self.record)
+        return False
+
+    def set(self, **fields):
+        """补充行数 (rows)、字节数 (bytes) 等字段"""
+        self.record.update(fields)
+
+    def measure(self, data):
+        """按数据补充 rows / bytes"""
+        if data is not None and hasattr(data, "__len__"):
+            self.record["rows"] = len(data)
+        self.record["bytes"] = nbytes(data)
+
+def begin_run(enabled, page="app"):
+    """
+    脚本每次重跑开头调用；enabled=False 时本次重跑的 span 全部是空操作。
+    上一次重跑若被 st.rerun()/st.stop() 中断而没走到 end_run，先把它补写进日志并返回
+    """
+    leftover = end_run(aborted=True) if is_enabled() else None
+    _local.run = {"page": page, "started": time.time(), "t0": time.perf_counter(), "spans": []} if enabled else None
+    return leftover
+
+def is_enabled():
+    return getattr(_local, "run", None) is not None
+
+def span(name, **fields):
+    """
+    计时片段：with span("conn.read") as s: ...; s.set(rows=...)
+    当前线程没有开启计时时返回空对象
+    """
+    run = getattr(_local, "run", None)
+    if run is None:
+        return _NOOP
+    return _Span(name, run["spans"].append, fields)
+
+def end_run(aborted=False):
+    """结束本次重跑：写一行 JSON 日志，返回本次记录（未开启返回 None）"""
+    run = getattr(_local, "run", None)
+    _local.run = None
+    if run is None:
+        return None
+    record = {
+        "ts": datetime.fromtimestamp(run["started"]).isoformat(timespec="milliseconds"),
+        "page": run["page"],
+        "total_ms": round((time.perf_counter() - run["t0"]) * 1000, 3),
+        "spans": run["spans"],
+    }
+    if aborted:
+        # 被中断的重跑没有可靠的结束时间，只保留各片段
+        del record["total_ms"]
+        record["aborted"] = True
+    write_log(record)
+    return record
+
+def write_log(record, path=PERF_LOG_PATH):
+    try:
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with _log_lock, open(path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+    except OSError as e:
+        print(f"⚠️ 计时日志写入失败: {e}")
+
+def timed(name, fn, **fields):
+    """
+    包装在脚本线程之外执行的函数（如下载按钮的延迟生成回调）：
+    开启计时时每次调用单独写一行日志，未开启时原样返回 fn
+    """
+    if not is_enabled():
+        return fn
+
+    def wrapper(*args, **kwargs):
+        t0 = time.perf_counter()
+        result = fn(*args, **kwargs)
+        log_span(name, page="callback", **fields, ms=round((time.perf_counter() - t0) * 1000, 3), bytes=nbytes(result))
+        return result
+    return wrapper
+
+def log_span(name, page="background", **fields):
+    """脚本线程之外（回调、后台线程）完成的一段计时，单独写一行日志"""
+    write_log({"ts": datetime.now().isoformat(timespec="milliseconds"), "page": page, "spans": [{"name": name, **fields}]})
@@ -0,0 +1,329 @@
+import os
+import sqlite3
+import threading
+import pandas as pd
+import streamlit as st
+from logic import STANDARD_COLUMNS, MONEY_COLUMNS, clean_money
+
+# =========================================================
+# 账本存储后端：Google Sheets / 本地 SQLite / 内存
+# =========================================================
+# 行位置 (pos) 从 0 开始，对应表格第 pos + 2 行（第 1 行为表头）。
+# 所有后端读出的都是 STANDARD_COLUMNS 顺序的原始值，清洗统一交给 normalize_ledger。
+
+LEDGER_WORKSHEET = "Summary"
+STORE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ledger.sqlite")
+
+def _frame(rows):
+    return pd.DataFrame(rows, columns=STANDARD_COLUMNS)
+
+def _cell(val):
+    """把单元格值转成可写入的标量（空值写为空串）"""
+    if val is None or (isinstance(val, float) and pd.isna(val)):
+        return ""
+    if hasattr(val, "item"):  # numpy 标量
+        return val.item()
+    return val
+
+def _rows(df):
+    """DataFrame -> 按 STANDARD_COLUMNS 排列的二维列表"""
+    return [[_cell(x) for x in row] for row in df.reindex(columns=STANDARD_COLUMNS).itertuples(index=False)]
+
+class LedgerStore:
+    """
+    账本存储接口。子类至少实现 row_count / read / append_rows / update_rows / delete_rows；
+    read_keys、tail_matches 与 keys_match 有通用实现，后端可按需覆盖成更省流量的版本。
+    """
+    name = "base"
+
+    def row_count(self):
+        raise NotImplementedError
+
+    def read(self, start=0, stop=None):
+        """读取 [start, stop) 行，返回 STANDARD_COLUMNS 的 DataFrame"""
+        raise NotImplementedError
+
+    def append_rows(self, rows_df):
+        """在末尾追加行"""
+        raise NotImplementedError
+
+    def update_rows(self, start, rows_df):
+        """从 start 行起逐行覆盖 len(rows_df) 行，超出现有行数的部分追加"""
+        raise NotImplementedError
+
+    def delete_rows(self, start, stop):
+        """删除 [start, stop) 行，其后的行依次上移"""
+        raise NotImplementedError
+
+    # --- 通用实现 ---
+    def read_keys(self):
+        """每行的 (录入编号, 修改时间)，供本地镜像做增量比对"""
+        df = self.read()
+        return list(zip(df['录入编号'].fillna("").astype(str), df['修改时间'].fillna("").astype(str)))
+
+    def tail_matches(self, n_rows, last_id):
+        """存储里恰好有 n_rows 行且末行编号为 last_id（即加载之后没有人改动末尾）"""
+        if self.row_count() != n_rows:
+            return False
+        if n_rows == 0:
+            return True
+        return str(self.read(n_rows - 1, n_rows)['录入编号'].iloc[0]) == str(last_id)
+
+    def keys_match(self, start, keys):
+        """
+        存储从 start 行到末尾的 (录入编号, 修改时间) 是否与 keys 完全一致：
+        行数相同、其间没有增删或改动，按位置改写/删除前用它核对
+        """
+        return self.read_keys()[start:] == [(str(a), str(b)) for a, b in keys]
+
+    def append(self, rows_df, expect_rows=None, expect_last_id=None):
+        """
+        乐观追加：给出 expect_rows 时先核对末尾是否仍与加载时一致，不一致不写入。
+        返回是否已追加
+        """
+        if expect_rows is not None and not self.tail_matches(expect_rows, expect_last_id):
+            return False
+        self.append_rows(rows_df)
+        return True
+
+    def replace_all(self, df):
+        """整表覆盖（追加冲突时的回退）"""
+        n = self.row_count()
+        self.update_rows(0, df)
+        if n > len(df):
+            self.delete_rows(len(df), n)
+
+class MemoryLedgerStore(LedgerStore):
+    """内存后端：测试与性能基准用，不访问网络也不落盘"""
+    name = "memory"
+
+    def __init__(self, df=None):
+        self._lock = threading.Lock()
+        self._data = _rows(df) if df is not None else []
+
+    def row_count(self):
+        return len(self._data)
+
+    def read(self, start=0, stop=None):
+        with self._lock:
+            return _frame([list(r) for r in self._data[start:stop]])
+
+    def append_rows(self, rows_df):
+        with self._lock:
+            self._data.extend(_rows(rows_df))
+
+    def update_rows(self, start, rows_df):
+        with self._lock:
+            rows = _rows(rows_df)
+            self._data[start:start + len(rows)] = rows
+
+    def delete_rows(self, start, stop):
+        with self._lock:
+            del self._data[start:stop]
+
+    def truncate(self, n_rows):
+        """只保留前 n_rows 行（性能基准在每轮之间复位用）"""
+        with self._lock:
+            del self._data[n_rows:]
+
+def _q(col):
+    """SQLite 列名加引号（表头含中文、括号和斜杠）"""
+    return '"' + col.replace('"', '""') + '"'
+
+class SqliteLedgerStore(LedgerStore):
+    """本地 SQLite 后端：单机/离线部署直接以它为账本，金额列存 REAL"""
+    name = "sqlite"
+
+    def __init__(self, path=STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._cols = ", ".join(_q(c) for c in STANDARD_COLUMNS)
+        with self._db() as db:
+            cols = ", ".join(f"{_q(c)} {'REAL' if c in MONEY_COLUMNS else 'TEXT'}" for c in STANDARD_COLUMNS)
+            db.execute(f"CREATE TABLE IF NOT EXISTS ledger (pos INTEGER PRIMARY KEY, {cols})")
+
+    def _db(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def _values(self, rows_df, start):
+        df = rows_df.reindex(columns=STANDARD_COLUMNS).reset_index(drop=True)
+        for col in MONEY_COLUMNS:
+            df[col] = clean_money(df[col])
+        df.insert(0, "pos", range(start, start + len(df)))
+        return df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+
+    def row_count(self):
+        with self._db() as db:
+            return db.execute("SELECT COUNT(*) FROM ledger").fetchone()[0]
+
+    def read(self, start=0, stop=None):
+        sql = f"SELECT {self._cols} FROM ledger WHERE pos >= ?"
+        args = [start]
+        if stop is not None:
+            sql += " AND pos < ?"
+            args.append(stop)
+        with self._db() as db:
+            return pd.read_sql_query(sql + " ORDER BY pos", db, params=args)
+
+    def read_keys(self):
+        with self._db() as db:
+            rows = db.execute(f"SELECT {_q('录入编号')}, {_q('修改时间')} FROM ledger ORDER BY pos").fetchall()
+        return [(str(a or ""), str(b or "")) for a, b in rows]
+
+    def append_rows(self, rows_df):
+        with self._lock, self._db() as db:
+            start = db.execute("SELECT COUNT(*) FROM ledger").fetchone()[0]
+            self._insert(db, rows_df, start)
+
+    def append(self, rows_df, expect_rows=None, expect_last_id=None):
+        # 核对与追加放在同一事务里，多个会话同时提交也不会交错
+        with self._lock, self._db() as db:
+            db.execute("BEGIN IMMEDIATE")
+            n = db.execute("SELECT COUNT(*) FROM ledger").fetchone()[0]
+            if expect_rows is not None:
+                if n != expect_rows:
+                    return False
+                if n:
+                    last = db.execute(f"SELECT {_q('录入编号')} FROM ledger WHERE pos = ?", (n - 1,)).fetchone()
+                    if last is None or str(last[0]) != str(expect_last_id):
+                        return False
+            self._insert(db, rows_df, n)
+            return True
+
+    def _insert(self, db, rows_df, start):
+        placeholders = ", ".join("?" * (len(STANDARD_COLUMNS) + 1))
+        db.executemany(
+            f"INSERT OR REPLACE INTO ledger (pos, {self._cols}) VALUES ({placeholders})",
+            self._values(rows_df, start),
+        )
+
+    def update_rows(self, start, rows_df):
+        with self._lock, self._db() as db:
+            self._insert(db, rows_df, start)
+
+    def delete_rows(self, start, stop):
+        with self._lock, self._db() as db:
+            db.execute("DELETE FROM ledger WHERE pos >= ? AND pos < ?", (start, stop))
+            # 先翻成负数再平移，避免主键在逐行更新时冲突
+            db.execute("UPDATE ledger SET pos = -(pos - ?) WHERE pos >= ?", (stop - start, stop))
+            db.execute("UPDATE ledger SET pos = -pos WHERE pos < 0")
+
+class GSheetsLedgerStore(LedgerStore):
+    """
+    Google Sheets 后端（沿用 st-gsheets-connection 的连接）。
+    服务账号模式下直接用底层 gspread Worksheet 做区间读写；
+    公开链接模式只能整表读取，写操作退回 conn.update 整表覆盖
+    """
+    name = "gsheets"
+
+    def __init__(self, conn, worksheet=LEDGER_WORKSHEET):
+        self.conn = conn
+        self.worksheet = worksheet
+        self._last_col = chr(ord("A") + len(STANDARD_COLUMNS) - 1)
+
+    def _ws(self):
+        """取出底层 gspread Worksheet；公开链接模式不支持区间读写，返回 None"""
+        select = getattr(getattr(self.conn, "client", None), "_select_worksheet", None)
+        if select is None:
+            return None
+        return select(worksheet=self.worksheet)
+
+    def _read_all(self):
+        df = self.conn.read(worksheet=self.worksheet, ttl=0)
+        return df.reindex(columns=STANDARD_COLUMNS)
+
+    def _header_ok(self, ws):
+        return ws.row_values(1)[:len(STANDARD_COLUMNS)] == STANDARD_COLUMNS
+
+    def _pad(self, rows):
+        return [list(r) + [""] * (len(STANDARD_COLUMNS) - len(r)) for r in rows]
+
+    def row_count(self):
+        ws = self._ws()
+        if ws is None:
+            return len(self._read_all())
+        return len(ws.get("A2:A"))
+
+    def read(self, start=0, stop=None):
+        ws = self._ws()
+        if ws is None or not self._header_ok(ws):
+            # 表头被调整过时列位置不可信，按表头名整表对齐
+            return self._read_all().iloc[start:stop].reset_index(drop=True)
+        end = f"{self._last_col}{stop + 1}" if stop is not None else self._last_col
+        if stop is not None and stop <= start:
+            return _frame([])
+        return _frame(self._pad(ws.get(f"A{start + 2}:{end}")))
+
+    def read_keys(self):
+        ws = self._ws()
+        if ws is None or not self._header_ok(ws):
+            return super().read_keys()
+        id_col, mt_col = ws.batch_get(["A2:A", "C2:C"])
+        return [
+            (r[0] if r else "", (mt_col[i][0] if i < len(mt_col) and mt_col[i] else ""))
+            for i, r in enumerate(id_col)
+        ]
+
+    def tail_matches(self, n_rows, last_id):
+        ws = self._ws()
+        if ws is None:
+            return False  # 公开链接模式不能追加，交给调用方走整表回退
+        # 只读编号列两格：第 n+1 行应为加载时的末行，第 n+2 行应为空
+        expected = str(last_id) if n_rows else "录入编号"
+        tail = ws.get(f"A{n_rows + 1}:A{n_rows + 2}")
+        return len(tail) == 1 and bool(tail[0]) and str(tail[0][0]) == expected
+
+    def append_rows(self, rows_df):
+        ws = self._ws()
+        if ws is None:
+            full = pd.concat([self._read_all(), rows_df.reindex(columns=STANDARD_COLUMNS)], ignore_index=True)
+            self.conn.update(worksheet=self.worksheet, data=full)
+            return
+        ws.append_rows(_rows(rows_df), value_input_option="USER_ENTERED", table_range="A1")
+
+    def update_rows(self, start, rows_df):
+        ws = self._ws()
+        if ws is None:
+            full = self._read_all()
+            rows = rows_df.reindex(columns=STANDARD_COLUMNS).reset_index(drop=True)
+            full = pd.concat([full.iloc[:start], rows, full.iloc[start + len(rows):]], ignore_index=True)
+            self.conn.update(worksheet=self.worksheet, data=full)
+            return
+        if len(rows_df):
+            ws.update(range_name=f"A{start + 2}", values=_rows(rows_df), value_input_option="USER_ENTERED")
+
+    def delete_rows(self, start, stop):
+        if stop <= start:
+            return
+        ws = self._ws()
+        if ws is None:
+            full = self._read_all()
+            full = full.drop(full.index[start:stop])
+            self.conn.update(worksheet=self.worksheet, data=full)
+            return
+        ws.delete_rows(start + 2, stop + 1)
+
+    def replace_all(self, df):
+        # 整表覆盖直接交给连接的 update（一次请求）
+        self.conn.update(worksheet=self.worksheet, data=df)
+
+def _backend_setting():
+    """后端选择：环境变量 LEDGER_BACKEND 优先，其次 secrets 里的 LEDGER_BACKEND，默认 gsheets"""
+    backend = os.environ.get("LEDGER_BACKEND")
+    if not backend:
+        try:
+            backend = st.secrets.get("LEDGER_BACKEND")
+        except Exception:
+            backend = None
+    return (backend or "gsheets").lower()
+
+@st.cache_resource
+def get_ledger_store(backend=None):
+    """进程内共享的账本存储"""
+    backend = backend or _backend_setting()
+    if backend == "sqlite":
+        return SqliteLedgerStore(os.environ.get("LEDGER_SQLITE_PATH", STORE_PATH))
+    if backend == "memory":
+        return MemoryLedgerStore()
+    from streamlit_gsheets import GSheetsConnection
+    return GSheetsLedgerStore(st.connection("gsheets", type=GSheetsConnection))
@@ -0,0 +1,58 @@
+import pandas as pd
+
+from logic import STANDARD_COLUMNS, LedgerIndex, OptionIndex, normalize_ledger, to_sheet_frame
+
+
+def test_empty_ledger_round_trip():
+    # 加载失败时 load_data 返回空账本，导出/写入都要能从它开始
+    empty = normalize_ledger(pd.DataFrame())
+    out = to_sheet_frame(empty)
+    assert out.empty
+    assert list(out.columns) == STANDARD_COLUMNS
+
+
+def test_empty_partition_round_trip():
+    # 有数据的账本切出空分区（时间列已是 datetime64）也能还原
+    df = normalize_ledger(pd.DataFrame([{
+        "录入编号": "R20240101001", "提交时间": "2024-01-01 09:30", "修改时间": "",
+        "收入(USD)": 10, "支出(USD)": 0, "余额(USD)": 10, "实际金额": 10, "实际币种": "USD",
+    }]))
+    assert pd.api.types.is_datetime64_any_dtype(df["提交时间"])
+    out = to_sheet_frame(df.iloc[:0])
+    assert out.empty and out["提交时间"].dtype == object
+
+
+def test_round_trip_keeps_sheet_values():
+    raw = pd.DataFrame([
+        {"录入编号": "R20240101001", "提交时间": "2024-01-01 09:30", "修改时间": "", "结算账户": "现金",
+         "实际金额": "1,234.56", "实际币种": "USD", "收入(USD)": 1234.56, "支出(USD)": 0, "余额(USD)": 1234.56},
+        {"录入编号": "R20240102001", "提交时间": "2024-01-02 10:00", "修改时间": "2024-01-03 08:00", "结算账户": "",
+         "实际金额": 20, "实际币种": "USD", "收入(USD)": 0, "支出(USD)": 20.1, "余额(USD)": 1214.46},
+    ])
+    out = to_sheet_frame(normalize_ledger(raw))
+    assert out["提交时间"].tolist() == ["2024-01-01 09:30", "2024-01-02 10:00"]
+    assert out["修改时间"].tolist() == ["", "2024-01-03 08:00"]
+    assert out["余额(USD)"].tolist() == [1234.56, 1214.46]
+    assert out["实际金额"].tolist() == [1234.56, 20.0]
+
+
+def test_ledger_index_update_leaves_old_revision_intact():
+    # 旧版本的索引可能还被其他会话使用，派生新版本不能改动它
+    old_df = pd.DataFrame({"录入编号": ["R20240101001", "R20240101002", "R20240101003"]})
+    new_df = pd.DataFrame({"录入编号": ["R20240101001", "R20240101003"]})
+    old = LedgerIndex(old_df, revision=1)
+    new = old.updated(1, new_df, revision=2)
+    assert (old.revision, old.position("R20240101003"), old.next_serial("20240101")) == (1, 2, 4)
+    assert (new.revision, new.position("R20240101003"), new.position("R20240101002")) == (2, 1, None)
+    assert new.next_serial("20240101") == 4
+    # 删掉当日最大流水号后，从未改动的前段重新求
+    newer = new.updated(1, old_df.iloc[:2], revision=3)
+    assert newer.next_serial("20240101") == 3 and new.next_serial("20240101") == 4
+
+
+def test_option_index_update_leaves_old_revision_intact():
+    old = OptionIndex(pd.DataFrame({"经手人": ["张三", "李四", "张三"]}), cols=["经手人"], revision=1)
+    assert old.options("经手人", ranked=True) == ["张三", "李四"]
+    new = old.updated(pd.DataFrame({"经手人": ["李四"]}), pd.DataFrame({"经手人": ["王五"]}), revision=2)
+    assert old.options("经手人") == ["张三", "李四"] and old.revision == 1
+    assert new.options("经手人") == ["张三", "王五"] and new.revision == 2
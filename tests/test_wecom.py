@@ -0,0 +1,111 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+import requests
+
+import wecom
+
+# 两页列表：第二页与第一页有重复单号，模拟翻页期间列表变化
+PAGES = {
+    "": {"sp_no_list": ["sp3", "sp1", "sp2"], "new_next_cursor": "page2"},
+    "page2": {"sp_no_list": ["sp2", "sp5", "sp4"]},
+}
+SLOW_SP_NO = "slow"
+
+
+class FakeWeCom(BaseHTTPRequestHandler):
+    """本地企微桩服务：gettoken / getapprovalinfo / getapprovaldetail"""
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, body):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        calls = self.server.calls
+        calls.append(url.path)
+        if url.path == "/gettoken" and parse_qs(url.query).get("corpsecret") == ["secret"]:
+            self._reply({"errcode": 0, "access_token": "tok", "expires_in": 7200})
+        else:
+            self._reply({"errcode": 40001, "errmsg": "invalid credential"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.calls.append(url.path)
+        if parse_qs(url.query).get("access_token") != ["tok"]:
+            return self._reply({"errcode": 40014, "errmsg": "invalid access_token"})
+        if url.path == "/oa/getapprovalinfo":
+            return self._reply({"errcode": 0, **PAGES[payload.get("new_cursor", "")]})
+        sp_no = payload["sp_no"]
+        if sp_no == SLOW_SP_NO:
+            time.sleep(1)
+        with self.server.lock:
+            busy = self.server.busy.pop(sp_no, 0)
+            if busy:
+                self.server.busy[sp_no] = busy - 1
+        if busy:
+            return self._reply({"errcode": 45033, "errmsg": "api concurrent out of limit"})
+        self._reply({"errcode": 0, "info": {"sp_no": sp_no}})
+
+
+@pytest.fixture
+def server():
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), FakeWeCom)
+    srv.daemon_threads = True
+    srv.calls, srv.busy, srv.lock = [], {}, threading.Lock()
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    srv.api_base = f"http://127.0.0.1:{srv.server_address[1]}"
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+def test_token_cache_reuses_token(server):
+    cache, session = wecom.TokenCache(), requests.Session()
+    assert cache.get(session, server.api_base, "corp", "secret") == ("tok", None)
+    assert cache.get(session, server.api_base, "corp", "secret") == ("tok", None)
+    assert server.calls.count("/gettoken") == 1
+    token, errmsg = cache.get(session, server.api_base, "corp", "wrong")
+    assert token is None and errmsg == "invalid credential"
+
+
+def test_list_approvals_follows_cursor_and_dedups(server):
+    sp_nos, err = wecom.list_approvals(requests.Session(), "tok", "tpl", 0, 3600, api_base=server.api_base)
+    assert err is None
+    assert sp_nos == ["sp3", "sp1", "sp2", "sp5", "sp4"]
+    assert server.calls.count("/oa/getapprovalinfo") == 2
+
+
+def test_list_approvals_returns_error_response(server):
+    sp_nos, err = wecom.list_approvals(requests.Session(), "bad", "tpl", 0, 3600, api_base=server.api_base)
+    assert sp_nos == [] and err["errcode"] == 40014
+
+
+def test_fetch_details_keeps_order_and_retries_busy(server):
+    server.busy["sp2"] = 1
+    sp_nos = ["sp3", "sp1", "sp2", "sp5", "sp4"]
+    details = wecom.fetch_approval_details("tok", sp_nos, api_base=server.api_base, max_workers=4,
+                                           session=requests.Session())
+    assert [sp for sp, _ in details] == sp_nos
+    assert all(info == {"sp_no": sp} for sp, info in details)
+    # sp2 第一次返回 45033，退避后重试成功
+    assert server.calls.count("/oa/getapprovaldetail") == len(sp_nos) + 1
+
+
+def test_fetch_details_skips_timeouts(server, monkeypatch):
+    monkeypatch.setattr(wecom, "REQUEST_TIMEOUT", 0.2)
+    details = wecom.fetch_approval_details("tok", ["sp1", SLOW_SP_NO, "sp2"], api_base=server.api_base,
+                                           session=requests.Session())
+    assert [sp for sp, _ in details] == ["sp1", "sp2"]
@@ -0,0 +1,44 @@
+import threading
+import time
+import streamlit as st
+
+# =========================================================
+# 冷启动预热：登录页显示期间在后台准备首屏数据
+# =========================================================
+# 本模块顶层只依赖 streamlit。pandas、账本存储等重模块在预热线程里才导入，
+# 用户输入账号密码的同时完成镜像同步，并把首屏要读的分区放进 read_ledger 缓存。
+
+@st.cache_resource
+def _prewarm_state():
+    # 进程内共享：{thread, error, ms}
+    return {"lock": threading.Lock(), "thread": None, "error": None, "ms": None}
+
+def _prewarm(state):
+    t0 = time.perf_counter()
+    try:
+        import forms, export  # noqa: F401  首屏与弹窗用到的模块（连带 pandas、logic）
+        from store import get_ledger_store
+        from mirror import get_mirror, read_ledger, read_summaries, UNDATED
+
+        store, mirror = get_ledger_store(), get_mirror()
+        # 与登录后的同步共用镜像的后台线程，登录后只需等它结束
+        mirror.sync_async(store, wait=None)
+        rev = mirror.revision
+        partitions, _ = read_summaries(rev)
+        # 看板默认显示最近一年，键与 app.load_data(years=[sel_year]) 一致
+        years = [int(y) for y in partitions['年'] if y != UNDATED]
+        if years:
+            read_ledger(rev, (max(years),))
+    except Exception as e:
+        state["error"] = e
+        print(f"⚠️ 启动预热失败，登录后再按需加载: {e}")
+    state["ms"] = round((time.perf_counter() - t0) * 1000, 3)
+
+def start_prewarm():
+    """每个进程只预热一次；已在进行或已完成时直接返回该线程"""
+    state = _prewarm_state()
+    with state["lock"]:
+        if state["thread"] is None:
+            state["thread"] = threading.Thread(target=_prewarm, args=(state,), daemon=True)
+            state["thread"].start()
+    return state["thread"]
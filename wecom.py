@@ -0,0 +1,323 @@
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import requests
+from requests.adapters import HTTPAdapter
+import pandas as pd
+import streamlit as st
+from logic import get_rates_on, continue_balance, commit_rows, normalize_ledger
+
+# =========================================================
+# 企业微信审批单同步
+# =========================================================
+
+WECOM_API = "https://qyapi.weixin.qq.com/cgi-bin"
+MAX_WORKERS = 8        # 并发拉取详情的线程数上限
+REQUEST_TIMEOUT = 10   # 单次请求超时 (秒)
+MAX_RETRIES = 3        # 限频/系统繁忙时的重试次数
+RETRY_ERRCODES = {-1, 45009, 45033}  # 系统繁忙 / 接口调用超过限制 / 并发过高
+TOKEN_ERRCODES = {40001, 40014, 42001}  # access_token 无效 / 已过期
+TOKEN_REFRESH_MARGIN = 300  # 提前多少秒刷新 access_token
+
+PAGE_SIZE = 100                    # 审批列表每页条数 (接口上限 100)
+FIRST_SYNC_DAYS = 30               # 没有水位线时首次回溯的天数
+MAX_WINDOW_SECONDS = 30 * 24 * 3600  # 单次查询时间跨度上限 (接口限制 31 天)
+# 列表按提交时间筛选，向前重叠一段以覆盖审批耗时；已同步的单号不拉详情，重叠长一些只多几页列表
+OVERLAP_SECONDS = MAX_WINDOW_SECONDS
+WATERMARK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".wecom_watermark.json")
+
+_session_lock = threading.Lock()
+_session = None
+
+def get_session():
+    """进程内共享的 keep-alive 会话，连接池大小与并发线程数一致"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+def _post(session, url, payload):
+    """带超时的 POST；遇到限频类错误码按指数退避重试"""
+    for attempt in range(MAX_RETRIES + 1):
+        res = session.post(url, json=payload, timeout=REQUEST_TIMEOUT).json()
+        if res.get("errcode") not in RETRY_ERRCODES or attempt == MAX_RETRIES:
+            return res
+        time.sleep(0.5 * (2 ** attempt))
+    return res
+
+def fetch_approval_details(token, sp_nos, api_base=WECOM_API, max_workers=MAX_WORKERS, session=None):
+    """
+    并发拉取审批详情，返回与 sp_nos 顺序一致的 [(sp_no, info)]；
+    单据请求失败或返回错误码的跳过，不影响其余单据
+    """
+    session = session or get_session()
+    url = f"{api_base}/oa/getapprovaldetail?access_token={token}"
+
+    def _fetch(sp_no):
+        try:
+            res = _post(session, url, {"sp_no": sp_no})
+        except Exception as e:
+            print(f"⚠️ 审批单 {sp_no} 详情获取失败: {e}")
+            return None
+        return res.get("info", {}) if res.get("errcode") == 0 else None
+
+    if not sp_nos:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(sp_nos))) as pool:
+        infos = list(pool.map(_fetch, sp_nos))
+    return [(sp_no, info) for sp_no, info in zip(sp_nos, infos) if info is not None]
+
+# --- Access Token 缓存 ---
+class TokenCache:
+    """
+    进程内共享的 access_token 缓存（企微 token 有效期 2 小时且 gettoken 限频）。
+    到期前 TOKEN_REFRESH_MARGIN 秒才刷新；多个会话同时同步时，
+    只有拿到锁的那个去刷新，其余等待后直接复用同一个 token
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tokens = {}  # (api_base, corpid, secret) -> (token, 过期时间戳)
+
+    def _valid(self, key):
+        entry = self._tokens.get(key)
+        if entry and entry[1] - TOKEN_REFRESH_MARGIN > time.time():
+            return entry[0]
+        return None
+
+    def get(self, session, api_base, corpid, secret):
+        """返回 (token, 错误信息)；获取失败时 token 为 None"""
+        key = (api_base, corpid, secret)
+        token = self._valid(key)
+        if token:
+            return token, None
+        with self._lock:
+            token = self._valid(key)  # 等锁期间可能已被其他会话刷新
+            if token:
+                return token, None
+            res = session.get(f"{api_base}/gettoken?corpid={corpid}&corpsecret={secret}", timeout=REQUEST_TIMEOUT).json()
+            token = res.get("access_token")
+            if not token:
+                return None, res.get("errmsg")
+            self._tokens[key] = (token, time.time() + int(res.get("expires_in", 7200)))
+            return token, None
+
+    def invalidate(self, api_base, corpid, secret, token):
+        """token 被企微判定失效时丢弃（仅当缓存里还是这一个，避免误删别人刚刷新的）"""
+        key = (api_base, corpid, secret)
+        with self._lock:
+            if self._tokens.get(key, (None,))[0] == token:
+                del self._tokens[key]
+
+_token_cache = TokenCache()
+
+# --- 同步水位线 ---
+_watermark_lock = threading.Lock()
+
+def load_watermark(path=WATERMARK_PATH):
+    """
+    读取同步水位线：last_finish_time 为已同步单据的最晚完成时间，
+    last_sync_time 为上次成功查完列表的时刻（旧水位线文件没有时取 last_finish_time），
+    synced 为 {sp_no: 完成时间}，用于 O(1) 判断单据是否已同步
+    """
+    try:
+        with open(path, encoding="utf-8") as f:
+            wm = json.load(f)
+        last_finish = int(wm.get("last_finish_time", 0))
+        return {"last_finish_time": last_finish, "last_sync_time": int(wm.get("last_sync_time", last_finish)),
+                "synced": dict(wm.get("synced", {}))}
+    except (OSError, ValueError):
+        return {"last_finish_time": 0, "last_sync_time": 0, "synced": {}}
+
+def window_start(wm, now):
+    """
+    列表查询的起点：上次成功同步的时刻向前重叠 OVERLAP_SECONDS。
+    以同步时刻而非最晚完成时间为锚，长时间没有新单据时窗口也不会越拉越长
+    """
+    if wm["last_sync_time"]:
+        return wm["last_sync_time"] - OVERLAP_SECONDS
+    return now - FIRST_SYNC_DAYS * 24 * 3600
+
+def save_watermark(wm, path=WATERMARK_PATH):
+    """原子写入水位线，并清理已滑出下次查询窗口的 sp_no（它们不会再出现在列表里）"""
+    floor = window_start(wm, int(time.time()))
+    wm = {"last_finish_time": wm["last_finish_time"], "last_sync_time": wm["last_sync_time"],
+          "synced": {sp: ts for sp, ts in wm["synced"].items() if ts >= floor}}
+    with _watermark_lock:
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(wm, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+def list_approvals(session, token, template_id, starttime, endtime, api_base=WECOM_API):
+    """
+    按提交时间窗口列出已通过的审批单号：跨度超过 30 天时分段查询，
+    每段沿 next_cursor 翻页直到取完。返回 (sp_no 列表, 出错时的响应)
+    """
+    url = f"{api_base}/oa/getapprovalinfo?access_token={token}"
+    sp_nos = []
+    win_start = starttime
+    while win_start < endtime:
+        win_end = min(win_start + MAX_WINDOW_SECONDS, endtime)
+        cursor = {"cursor": 0}
+        while True:
+            payload = {
+                "starttime": str(win_start), "endtime": str(win_end), "size": PAGE_SIZE,
+                "filters": [{"key": "template_id", "value": template_id}, {"key": "sp_status", "value": "2"}],
+                **cursor,
+            }
+            res = _post(session, url, payload)
+            if res.get("errcode", 0) != 0:
+                return sp_nos, res
+            sp_nos.extend(res.get("sp_no_list", []))
+            # 新版接口返回字符串游标 new_next_cursor，旧版为整数 next_cursor
+            if res.get("new_next_cursor"):
+                cursor = {"new_cursor": res["new_next_cursor"]}
+            elif res.get("next_cursor"):
+                cursor = {"cursor": res["next_cursor"]}
+            else:
+                break
+        win_start = win_end
+    return list(dict.fromkeys(sp_nos)), None
+
+def approval_to_row(sp_no, info, rates):
+    """把一张审批单映射为账本行；表单字段不完整时返回 None"""
+    contents = info.get("apply_data", {}).get("contents", [])
+    try:
+        # --- 核心字段映射 (根据 CSV 逻辑) ---
+        # contents[0]: 费用类型 (如 管理费)
+        # contents[1]: 申请事由
+        # contents[2]: 币种 (人民币/美元)
+        # contents[3]: 金额 (数字)
+        # contents[7]: 备注
+
+        cat_type = contents[0]['value']['text']
+        reason   = contents[1]['value']['text']
+        currency = contents[2]['value']['text']
+        raw_amt  = float(contents[3]['value']['new_number'])
+
+        # 币种对齐
+        final_curr = "CNY" if "人民币" in currency else "USD"
+
+        # 计算折合美元
+        exp_usd = round(raw_amt / rates.get(final_curr, 1.0), 2)
+
+        # 时间处理：使用完成时间 (sp_finish_time)
+        # 如果单据还没完成时间，用申请时间保底
+        finish_ts = info.get('sp_finish_time', info.get('apply_time'))
+        finish_dt = datetime.fromtimestamp(finish_ts).strftime('%Y-%m-%d %H:%M')
+
+        return {
+            "录入编号": f"WE-{sp_no[-8:]}",
+            "提交时间": finish_dt,  # ✅ 完成时间 对应 提交时间
+            "修改时间": "",
+            "摘要": reason,
+            "客户/项目信息": "企微同步",
+            "结算账户": "待分类",
+            "审批/发票单号": sp_no,  # ✅ 审批编号 对应 审批/发票单号
+            "资金性质": cat_type,
+            "实际金额": raw_amt,
+            "实际币种": final_curr,
+            "收入(USD)": 0.0,
+            "支出(USD)": exp_usd,
+            "余额(USD)": 0.0, # 稍后计算
+            "经手人": info.get("applyer", {}).get("name"),
+            "备注": contents[7]['value']['text'] if len(contents) > 7 else "来自企微同步"
+        }
+    except Exception:
+        return None
+
+def sync_wecom_to_sheets(store, current_df=None, api_base=None, watermark_path=WATERMARK_PATH, on_written=None):
+    """
+    从企业微信增量抓取已通过的审批单并追加到账本：
+    只查询水位线之后（含重叠期）提交的单据，已同步的 sp_no 直接跳过不拉详情；
+    current_df 为已加载的账本（用于编号去重与末尾核对），缺省时从 store 读取。
+    api_base 可指向本地桩服务做测试；on_written 见 logic.commit_rows
+    """
+    try:
+        CORPID = st.secrets["WECOM_CORPID"]
+        SECRET = st.secrets["WECOM_SECRET"]
+        TEMPLATE_ID = st.secrets["WECOM_TEMPLATE_ID"]
+        api_base = api_base or st.secrets.get("WECOM_API_BASE", WECOM_API)
+    except Exception:
+        return "❌ 请先在 Streamlit 后台配置 Secrets (ID, Secret, TemplateID)"
+
+    try:
+        session = get_session()
+
+        # 1. 获取 Access Token（进程内缓存，未临近过期不会请求 gettoken）
+        token, errmsg = _token_cache.get(session, api_base, CORPID, SECRET)
+        if not token: return f"❌ Token获取失败: {errmsg}"
+
+        # 2. 从水位线（向前重叠）开始，翻页获取全部已通过审批 (sp_status=2)
+        wm = load_watermark(watermark_path)
+        now = int(time.time())
+        starttime = window_start(wm, now)
+        sp_nos, err = list_approvals(session, token, TEMPLATE_ID, starttime, now, api_base=api_base)
+        if err is not None and err.get("errcode") in TOKEN_ERRCODES:
+            # 缓存的 token 被提前作废（如后台重置了 Secret），刷新后重试一次
+            _token_cache.invalidate(api_base, CORPID, SECRET, token)
+            token, errmsg = _token_cache.get(session, api_base, CORPID, SECRET)
+            if not token: return f"❌ Token获取失败: {errmsg}"
+            sp_nos, err = list_approvals(session, token, TEMPLATE_ID, starttime, now, api_base=api_base)
+        if err is not None:
+            st.sidebar.write("调试信息:", err)
+            # 这里的报错信息会根据腾讯返回的内容自动变化
+            return f"📭 抓取失败。返回码: {err.get('errcode')}, 原因: {err.get('errmsg', '无报错')}。"
+
+        # 3. 哈希索引去重：水位线里已同步的单号 + 账本里已有的 WE- 编号
+        if current_df is None:
+            current_df = normalize_ledger(store.read())
+        existing_ids = set(current_df['录入编号'].astype(str)) if '录入编号' in current_df.columns else set()
+        synced = wm["synced"]
+        todo = []
+        for sp_no in sp_nos:
+            if sp_no in synced:
+                continue
+            if f"WE-{sp_no[-8:]}" in existing_ids:
+                synced[sp_no] = now  # 账本里已有但水位线缺失（如水位线文件丢失）
+                continue
+            todo.append(sp_no)
+
+        # 4. 并发拉取新单据详情并合并成一批新行
+        new_rows, slow = [], []
+        if todo:
+            for sp_no, info in fetch_approval_details(token, todo, api_base=api_base, session=session):
+                finish_ts = int(info.get('sp_finish_time') or info.get('apply_time') or now)
+                apply_ts = int(info.get('apply_time') or finish_ts)
+                if finish_ts - apply_ts > OVERLAP_SECONDS:
+                    # 审批耗时超过重叠窗口：同样久的单据若提交早于本次窗口，将不会出现在列表里
+                    slow.append(sp_no)
+                # 按审批完成日的汇率折算
+                row = approval_to_row(sp_no, info, get_rates_on(datetime.fromtimestamp(finish_ts)))
+                if row:
+                    new_rows.append(row)
+                # 字段不全的单据同样记入水位线，审批通过后表单不会再变，无需反复拉取
+                synced[sp_no] = finish_ts
+                wm["last_finish_time"] = max(wm["last_finish_time"], finish_ts)
+
+        if new_rows:
+            new_frame = pd.DataFrame(new_rows)
+            # 只追加新行；末尾已变化时回退为读取最新数据后整表重算
+            commit_rows(store, current_df, lambda df: continue_balance(df, new_frame), on_written)
+
+        # 写入成功后才推进水位线；列表已查到 now，下次从 now 向前重叠即可
+        wm["last_sync_time"] = now
+        save_watermark(wm, watermark_path)
+        note = ""
+        if slow:
+            note = (f"\n\n⚠️ {len(slow)} 张审批单提交后超过 {OVERLAP_SECONDS // 86400} 天才完成"
+                    f"（{', '.join(slow[:5])}{' 等' if len(slow) > 5 else ''}），请核对是否有更早提交的单据漏同步")
+        if new_rows:
+            return f"✅ 成功从企微同步 {len(new_rows)} 条数据！{note}"
+        return f"😴 云端已是最新，无新单据需要同步{note}"
+
+    except Exception as e:
+        return f"❌ 出错了: {str(e)}"